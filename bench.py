@@ -0,0 +1,224 @@
+"""Нагрузочный прогон бота целиком, без сети.
+
+Поднимает настоящий run_server из bot.py в этом же процессе, а Bot API, DeepSeek и YooKassa
+подменяет локальным aiohttp-сервером; листы Google Sheets - таблицами в памяти (всё из fakes.py,
+с настраиваемыми задержками, ошибками и квотами).
+N синтетических пользователей проходят путь Vlasta: /start с deep-link, согласие, интервью,
+свободные сообщения до лимита (и оффер оплаты). Отчёт: апдейты/с, p50/p95/p99 от вебхука
+до конца обработки апдейта, пиковый RSS.
+
+    python bench.py --users 200 --llm-latency 0.8
+    python bench.py --users 200 --sheets-latency 0.15 --sheets-quota 60 --llm-tail-rate 0.02 --llm-tail 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession
+
+from fakes import FaultProfile, FakeBotAPI, FakeChatCompletions, FakeWorksheet, FakeYooKassa, Latency, Quota, serve
+
+
+# === Сценарий пользователя ===
+def user_script(bot, free_messages: int) -> list[tuple[str, str]]:
+    """Шаги пользователя: (вид шага для отчёта, текст сообщения)."""
+    scenario = bot.SCENARIOS['Vlasta']
+    limit = scenario.get('limit_value', 5)
+    script = [('start', '/start bench__Vlasta__utm_source=bench'), ('consent', 'Да')]
+    script += [('interview', f"Ответ на вопрос {i + 1}") for i in range(len(scenario['questions']))]
+    script += [('llm' if i < limit else 'limit', f"Свободное сообщение {i + 1}") for i in range(free_messages)]
+    return script
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"u{user_id}"},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def run(args):
+    random.seed(args.seed)
+    tg = FakeBotAPI(FaultProfile(quota=Quota(args.tg_quota, 1.0) if args.tg_quota else None, seed=args.seed))
+    llm = FakeChatCompletions(
+        FaultProfile(Latency(args.llm_latency, args.llm_sigma, args.llm_tail_rate, args.llm_tail),
+                     error_rate=args.llm_error_rate, seed=args.seed),
+        reply_tokens=args.llm_tokens, token_interval=args.llm_token_interval,
+    )
+    yk = FakeYooKassa(FaultProfile(Latency(0.05), seed=args.seed))
+    stand_runner = await serve([tg, llm, yk], args.stand_in_port)
+
+    import bot  # окружение выставлено в main() до импорта
+
+    # Листы в памяти вместо Google Sheets; квота Sheets общая на все листы (как у проекта)
+    sheets = FaultProfile(Latency(args.sheets_latency, 0.3 if args.sheets_latency else 0.0),
+                          error_rate=args.sheets_error_rate,
+                          quota=Quota(args.sheets_quota, 60.0) if args.sheets_quota else None, seed=args.seed)
+    bot.attach_sheets(
+        FakeWorksheet('Users', bot.USERS_COLUMNS, sheets),
+        FakeWorksheet('History', bot.HISTORY_COLUMNS, sheets),
+        FakeWorksheet('States', ['user_id', 'state_json', 'updated_at', 'last_activity_at'], sheets),
+    )
+
+    # Момент окончания обработки апдейта (после всех ответов хендлера)
+    waiting: dict[int, asyncio.Future] = {}
+    ingest_done = bot.ingest.done
+
+    def done(update=None):
+        ingest_done(update)
+        fut = waiting.pop(getattr(update, 'update_id', None), None)
+        if fut and not fut.done():
+            fut.set_result(time.monotonic())
+
+    bot.ingest.done = done
+
+    stop = asyncio.Event()
+    server = asyncio.create_task(bot.run_server(stop))
+    base = f"http://127.0.0.1:{args.port}"
+    async with ClientSession() as http:
+        for _ in range(200):
+            try:
+                async with http.get(f"{base}/health") as r:
+                    if r.status == 200:
+                        break
+            except Exception:
+                pass
+            await asyncio.sleep(0.05)
+        else:
+            raise RuntimeError('bot did not start')
+
+        latencies: list[float] = []
+        by_step: dict[str, list[float]] = {}
+        shed = 0
+        next_id = iter(range(1, 10 ** 9))
+        script = user_script(bot, args.free_messages)
+
+        async def simulate(user_id: int):
+            nonlocal shed
+            await asyncio.sleep(random.uniform(0, args.ramp))
+            for step, text in script:
+                update_id = next(next_id)
+                fut = asyncio.get_running_loop().create_future()
+                waiting[update_id] = fut
+                sent = time.monotonic()
+                async with http.post(f"{base}/webhook", json=make_update(update_id, user_id, text)) as r:
+                    reply = await r.read()
+                if reply != b'OK':
+                    # перегрузка: апдейт сброшен, Telegram получил «занято» в ответе вебхука
+                    waiting.pop(update_id, None)
+                    shed += 1
+                    continue
+                try:
+                    finished = await asyncio.wait_for(fut, args.timeout)
+                except asyncio.TimeoutError:
+                    waiting.pop(update_id, None)
+                    continue
+                latencies.append(finished - sent)
+                by_step.setdefault(step, []).append(finished - sent)
+                if args.think:
+                    await asyncio.sleep(random.uniform(0, args.think))
+
+        started = time.monotonic()
+        await asyncio.gather(*(simulate(10_000_000 + i) for i in range(args.users)))
+        elapsed = time.monotonic() - started
+
+    stop.set()
+    await server
+    await stand_runner.cleanup()
+
+    total = args.users * len(script)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    report = {
+        'users': args.users,
+        'updates_sent': total,
+        'updates_completed': len(latencies),
+        'updates_shed': shed,
+        'elapsed_s': round(elapsed, 2),
+        'updates_per_s': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'latency_p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'latency_max_ms': round(max(latencies, default=0) * 1000, 1),
+        'peak_rss_mb': round(peak_rss / 1024 / 1024, 1),
+        'p50_by_step_ms': {k: round(percentile(v, 0.50) * 1000, 1) for k, v in by_step.items()},
+        'telegram_calls': tg.stats.summary(),
+        'deepseek_calls': llm.stats.summary(),
+        'sheets_calls': {ws.title: ws.stats.summary() for ws in (bot.users_sheet, bot.history_sheet, bot.states_sheet)},
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        for k, v in report.items():
+            print(f"{k:>20}: {v}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load benchmark for bot.py (offline)')
+    parser.add_argument('--users', type=int, default=100, help='simulated users')
+    parser.add_argument('--free-messages', type=int, default=6, help='free messages per user after the interview (Vlasta limit is 5)')
+    parser.add_argument('--ramp', type=float, default=1.0, help='users start uniformly within this many seconds')
+    parser.add_argument('--think', type=float, default=0.0, help='max pause between a reply and the next message, s')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='stand-in DeepSeek median time to first byte, s')
+    parser.add_argument('--llm-sigma', type=float, default=0.3, help='log-normal spread of DeepSeek latency')
+    parser.add_argument('--llm-tail-rate', type=float, default=0.0, help='share of DeepSeek calls hitting the slow tail')
+    parser.add_argument('--llm-tail', type=float, default=0.0, help='slow-tail DeepSeek latency, s')
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help='share of DeepSeek calls answered with 503')
+    parser.add_argument('--llm-tokens', type=int, default=40, help='tokens per stand-in DeepSeek reply')
+    parser.add_argument('--llm-token-interval', type=float, default=0.01, help='delay between streamed tokens, s')
+    parser.add_argument('--sheets-latency', type=float, default=0.0, help='median delay per worksheet call, s')
+    parser.add_argument('--sheets-error-rate', type=float, default=0.0, help='share of worksheet calls failing with 503')
+    parser.add_argument('--sheets-quota', type=int, default=0, help='worksheet calls per minute before 429 (0 - unlimited)')
+    parser.add_argument('--tg-quota', type=int, default=0, help='Bot API calls per second before 429 (0 - unlimited)')
+    parser.add_argument('--seed', type=int, default=1, help='seed for all injected latencies and faults')
+    parser.add_argument('--timeout', type=float, default=120.0, help='per-update completion timeout, s')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--stand-in-port', type=int, default=18081)
+    parser.add_argument('--stream', choices=('0', '1'), default='1', help='DEEPSEEK_STREAM for the run')
+    parser.add_argument('--json', action='store_true', help='print the report as one JSON line')
+    args = parser.parse_args()
+
+    stand_in = f"http://127.0.0.1:{args.stand_in_port}"
+    os.environ.pop('GOOGLE_CREDENTIALS', None)
+    os.environ.update({
+        'BOT_TOKEN': '123456:bench',
+        'DEEPSEEK_API_KEY': 'bench',
+        'TELEGRAM_BASE_URL': f"{stand_in}/tg",
+        'DEEPSEEK_BASE_URL': f"{stand_in}/v1",
+        'YOOKASSA_API_URL': f"{stand_in}/yk",
+        'YOOKASSA_ACCOUNT_ID': 'bench',
+        'YOOKASSA_SECRET_KEY': 'bench',
+        'PAYMENT_PROVIDER_TOKEN': 'bench',
+        'WEBHOOK_BASE_URL': f"http://127.0.0.1:{args.port}",
+        'PORT': str(args.port),
+        'STORAGE_BACKEND': 'sheets',
+        'LOCAL_DATA_DIR': tempfile.mkdtemp(prefix='metapersona-bench-'),
+        'DEEPSEEK_WARMUP': '0',
+        'DEEPSEEK_STREAM': args.stream,
+        'STREAM_EDIT_INTERVAL': '0.2',
+        'START_TOKEN': '',
+    })
+    os.environ.pop('WEBHOOK_SECRET', None)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
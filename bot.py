@@ -6,13 +6,29 @@ import aiohttp
 import json
 import time
 import uuid
+import re
 import signal
+import random
+import bisect
+import contextvars
+import contextlib
+import functools
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from telegram import Update, LabeledPrice, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram import __version__ as tg_version
 import telegram.ext as tg_ext
-from telegram.ext import Application, CommandHandler, MessageHandler, PreCheckoutQueryHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, PreCheckoutQueryHandler, CallbackQueryHandler, filters, ContextTypes
 from telegram.constants import ParseMode
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # optional fast JSON parser
+    json_loads = json.loads
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
 
 logging.basicConfig(
     level=logging.INFO,
@@ -33,6 +49,88 @@ ENABLE_NOARGS_SCENARIO = os.environ.get('ENABLE_NOARGS_SCENARIO', '0') in ('1','
 WHITELIST_IDS = set(
     int(x) for x in os.environ.get('WHITELIST_IDS', '').split(',') if x.strip().isdigit()
 )
+# History write-behind: rows are flushed by append_rows in batches (by size or time window)
+HISTORY_BATCH_SIZE = max(1, int(os.environ.get('HISTORY_BATCH_SIZE', '50')))
+HISTORY_FLUSH_SECS = float(os.environ.get('HISTORY_FLUSH_SECS', '2'))
+HISTORY_MAX_PENDING = int(os.environ.get('HISTORY_MAX_PENDING', '20000'))
+# Local disk directory for caches/snapshots (recent-history index etc.)
+LOCAL_DATA_DIR = os.environ.get('LOCAL_DATA_DIR', 'data')
+RECENT_HISTORY_LIMIT = max(1, int(os.environ.get('RECENT_HISTORY_LIMIT', '20')))
+# Users kept in the recent-history index (least recently active are evicted) and its log flush interval
+RECENT_HISTORY_MAX_USERS = max(1, int(os.environ.get('RECENT_HISTORY_MAX_USERS', '20000')))
+RECENT_HISTORY_FLUSH_SECS = float(os.environ.get('RECENT_HISTORY_FLUSH_SECS', '1'))
+# Storage backend for user state: 'sheets' (Google Sheets only) or 'sqlite' (local SQLite, Sheets as async mirror)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sheets').strip().lower()
+SQLITE_PATH = os.environ.get('SQLITE_PATH') or os.path.join(LOCAL_DATA_DIR, 'metapersona.db')
+# Warm-start snapshot of user states in LOCAL_DATA_DIR (Sheets backend): written every N seconds and on shutdown; 0 disables
+STATE_SNAPSHOT_SECS = float(os.environ.get('STATE_SNAPSHOT_SECS', '300'))
+# Changed rows since the snapshot are fetched as row blocks; more blocks than this -> the whole state_json column at once
+STATE_SNAPSHOT_MAX_BLOCKS = int(os.environ.get('STATE_SNAPSHOT_MAX_BLOCKS', '20'))
+# Unchanged rows between two changed ones that are still read as part of one block
+STATE_SNAPSHOT_BLOCK_GAP = int(os.environ.get('STATE_SNAPSHOT_BLOCK_GAP', '20'))
+# Bot API endpoint (local Bot API server or a stand-in for benchmarks)
+TELEGRAM_BASE_URL = os.environ.get('TELEGRAM_BASE_URL', 'https://api.telegram.org').rstrip('/')
+# DeepSeek HTTP client (shared pooled session)
+DEEPSEEK_BASE_URL = os.environ.get('DEEPSEEK_BASE_URL', 'https://api.deepseek.com/v1').rstrip('/')
+HTTP_POOL_LIMIT = int(os.environ.get('HTTP_POOL_LIMIT', '100'))
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get('HTTP_POOL_LIMIT_PER_HOST', '50'))
+DEEPSEEK_WARMUP = os.environ.get('DEEPSEEK_WARMUP', '1') in ('1','true','True')
+# DeepSeek resilience: phase timeouts, jittered retries within a deadline, circuit breaker
+DEEPSEEK_CONNECT_TIMEOUT = float(os.environ.get('DEEPSEEK_CONNECT_TIMEOUT', '5'))
+DEEPSEEK_READ_TIMEOUT = float(os.environ.get('DEEPSEEK_READ_TIMEOUT', '30'))
+DEEPSEEK_DEADLINE = float(os.environ.get('DEEPSEEK_DEADLINE', '45'))
+DEEPSEEK_MAX_ATTEMPTS = max(1, int(os.environ.get('DEEPSEEK_MAX_ATTEMPTS', '3')))
+DEEPSEEK_BACKOFF_BASE = float(os.environ.get('DEEPSEEK_BACKOFF_BASE', '0.5'))
+DEEPSEEK_BACKOFF_CAP = float(os.environ.get('DEEPSEEK_BACKOFF_CAP', '8'))
+DEEPSEEK_BREAKER_FAILURES = int(os.environ.get('DEEPSEEK_BREAKER_FAILURES', '5'))
+DEEPSEEK_BREAKER_RESET_SECS = float(os.environ.get('DEEPSEEK_BREAKER_RESET_SECS', '30'))
+# Thread pool for blocking clients (gspread, YooKassa SDK)
+SYNC_POOL_SIZE = max(1, int(os.environ.get('SYNC_POOL_SIZE', '8')))
+# LLM admission control: in-flight limit + bounded fair queue (subscribers first)
+LLM_MAX_IN_FLIGHT = max(1, int(os.environ.get('LLM_MAX_IN_FLIGHT', '16')))
+LLM_QUEUE_MAX = int(os.environ.get('LLM_QUEUE_MAX', '200'))
+LLM_BUSY_MESSAGE = os.environ.get(
+    'LLM_BUSY_MESSAGE',
+    "Сейчас очень много запросов, я не успеваю ответить всем. Пожалуйста, напиши ещё раз через пару минут."
+)
+# Streaming replies: edit the "Думаю..." placeholder as tokens arrive (throttled for Telegram edit limits)
+DEEPSEEK_STREAM = os.environ.get('DEEPSEEK_STREAM', '1') in ('1','true','True')
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', '1.2'))
+TG_MESSAGE_LIMIT = 4096
+STREAM_BROKEN_MARK = " …[ответ прерван]"
+# In-memory conversation history per user: bounded by turns and bytes, older turns spill to disk
+CONVERSATION_MAX_TURNS = max(1, int(os.environ.get('CONVERSATION_MAX_TURNS', '40')))
+CONVERSATION_MAX_BYTES = int(os.environ.get('CONVERSATION_MAX_BYTES', str(64 * 1024)))
+CONVERSATION_SPILL_MAX_BYTES = int(os.environ.get('CONVERSATION_SPILL_MAX_BYTES', str(1024 * 1024)))
+# Rendered profile blocks cached by (scenario, interview answers)
+PROMPT_CACHE_SIZE = int(os.environ.get('PROMPT_CACHE_SIZE', '4096'))
+# Prompt context budget for history + current message (system prompt not included; tokens are estimated).
+# History is filled newest-to-oldest until the budget is spent; SCENARIOS[...]['context_tokens'] overrides it.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '3000'))
+CONTEXT_MAX_MESSAGES = int(os.environ.get('CONTEXT_MAX_MESSAGES', '40'))
+MAX_USER_INPUT_TOKENS = int(os.environ.get('MAX_USER_INPUT_TOKENS', '1200'))
+CHARS_PER_TOKEN = float(os.environ.get('CHARS_PER_TOKEN', '2.5'))
+# Webhook ingress de-duplication of Telegram retries (by update_id)
+UPDATE_DEDUP_SIZE = int(os.environ.get('UPDATE_DEDUP_SIZE', '10000'))
+UPDATE_DEDUP_SECS = float(os.environ.get('UPDATE_DEDUP_SECS', '900'))
+# Webhook ingestion: bounded queue in front of PTB, overload sheds non-critical updates
+INGEST_QUEUE_MAX = int(os.environ.get('INGEST_QUEUE_MAX', '1000'))
+INGEST_MAX_IN_PROCESS = int(os.environ.get('INGEST_MAX_IN_PROCESS', '256'))
+# Webhook supervisor: getWebhookInfo interval grows while healthy, drops to the minimum after problems
+WEBHOOK_CHECK_MIN_SECS = float(os.environ.get('WEBHOOK_CHECK_MIN_SECS', '15'))
+WEBHOOK_CHECK_MAX_SECS = float(os.environ.get('WEBHOOK_CHECK_MAX_SECS', '600'))
+WEBHOOK_PENDING_MAX = int(os.environ.get('WEBHOOK_PENDING_MAX', '100'))
+# Per-update tracing: every update is traced; fast ones are kept with TRACE_SAMPLE_RATE, slow/failed ones always
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.05'))
+TRACE_SLOW_SECS = float(os.environ.get('TRACE_SLOW_SECS', '5'))
+TRACE_RING_SIZE = int(os.environ.get('TRACE_RING_SIZE', '200'))
+TRACE_JSONL_PATH = os.environ.get('TRACE_JSONL_PATH', '')  # empty - in-memory ring only
+# /metrics endpoint: optional bearer token
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Startup: updates queue up until user states are restored, but no longer than this (then handlers run without Sheets)
+STARTUP_RESTORE_TIMEOUT = float(os.environ.get('STARTUP_RESTORE_TIMEOUT', '20'))
+# Global ceiling of updates processed concurrently (updates of one user are always serialized)
+MAX_CONCURRENT_UPDATES = max(1, int(os.environ.get('MAX_CONCURRENT_UPDATES', '64')))
 
 logger.info(f"PTB: {tg_version}")
 logger.info(f"PTB ext module: {tg_ext.__file__}")
@@ -55,14 +153,10 @@ logger.info(f"PAYMENT_PROVIDER_TOKEN: {'✅' if PAYMENT_PROVIDER_TOKEN else '❌
 YOOKASSA_ACCOUNT_ID = os.environ.get('YOOKASSA_ACCOUNT_ID')
 YOOKASSA_SECRET_KEY = os.environ.get('YOOKASSA_SECRET_KEY')
 YOOKASSA_RETURN_URL = os.environ.get('YOOKASSA_RETURN_URL') or (os.environ.get('WEBHOOK_BASE_URL') or os.environ.get('RENDER_EXTERNAL_URL') or '').rstrip('/') + '/pay/return'
-try:
-    if YOOKASSA_ACCOUNT_ID and YOOKASSA_SECRET_KEY:
-        from yookassa import Configuration
-        Configuration.account_id = YOOKASSA_ACCOUNT_ID
-        Configuration.secret_key = YOOKASSA_SECRET_KEY
-        logger.info('YooKassa SDK configured')
-except Exception as e:
-    logger.warning(f"YooKassa SDK not configured: {e}")
+YOOKASSA_API_URL = os.environ.get('YOOKASSA_API_URL', 'https://api.yookassa.ru/v3').rstrip('/')
+# Invoices live 24h; a cached invoice is reused until this many minutes before it expires
+YOOKASSA_INVOICE_TTL_HOURS = 24
+YOOKASSA_INVOICE_REUSE_MARGIN_MIN = int(os.environ.get('YOOKASSA_INVOICE_REUSE_MARGIN_MIN', '30'))
 
 # VK Pixel for /pay/return page
 VK_PIXEL_ID = os.environ.get('VK_PIXEL_ID', '3708556')
@@ -84,73 +178,72 @@ from aiohttp import web
 # We'll run a single aiohttp server for health + webhook
 
 # === GOOGLE SHEETS (опционально) ===
+USERS_COLUMNS = [
+    'user_id','interview_stage','interview_answers',
+    'daily_requests','last_date','custom_limit','is_active','created_at',
+    'scenario','free_used','utm_source','utm_medium','utm_campaign','utm_content','utm_term','ad_id',
+    'is_subscribed','subscription_until','last_payment_id'
+]
+HISTORY_COLUMNS = ['user_id','scenario','timestamp','role','message','free_used','daily_requests','interview_stage']
+# Листы подключаются в фоне уже после старта сервера: connect_sheets() в пуле, затем attach_sheets()
 users_sheet = None
 history_sheet = None
 states_sheet = None
 funnel_sheet = None
-if GOOGLE_CREDENTIALS_JSON:
+
+def connect_sheets():
+    """Авторизация, открытие (или создание) листов и проверка заголовков. Блокирующая - только через blocking."""
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    creds_dict = json.loads(GOOGLE_CREDENTIALS_JSON)
+    scope = [
+        'https://spreadsheets.google.com/feeds',
+        'https://www.googleapis.com/auth/drive',
+    ]
+    creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
+    gc = gspread.authorize(creds)
+    ss = gc.open(GOOGLE_SHEET_NAME)
     try:
-        import gspread
-        from google.oauth2.service_account import Credentials
-
-        creds_dict = json.loads(GOOGLE_CREDENTIALS_JSON)
-        scope = [
-            'https://spreadsheets.google.com/feeds',
-            'https://www.googleapis.com/auth/drive',
-        ]
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        gc = gspread.authorize(creds)
-        ss = gc.open(GOOGLE_SHEET_NAME)
-        try:
-            users_sheet = ss.worksheet('Users')
-        except Exception:
-            users_sheet = ss.add_worksheet(title='Users', rows=1000, cols=20)
-            users_sheet.append_row([
-                'user_id','interview_stage','interview_answers',
-                'daily_requests','last_date','custom_limit','is_active','created_at',
-                'scenario','free_used','utm_source','utm_medium','utm_campaign','utm_content','utm_term','ad_id',
-                'is_subscribed','subscription_until','last_payment_id'
-            ])
-        # Ensure Users header includes UTM columns (non-destructive append)
-        try:
-            u_headers = users_sheet.row_values(1)
-            needed_base = ['user_id','interview_stage','interview_answers','daily_requests','last_date','custom_limit','is_active','created_at']
-            needed_extra = ['scenario','free_used','utm_source','utm_medium','utm_campaign','utm_content','utm_term','ad_id','is_subscribed','subscription_until','last_payment_id']
-            needed = needed_base + needed_extra
-            if u_headers != needed:
-                users_sheet.update('A1', [needed])
-        except Exception:
-            pass
-        try:
-            history_sheet = ss.worksheet('History')
-        except Exception:
-            history_sheet = ss.add_worksheet(title='History', rows=5000, cols=10)
-            history_sheet.append_row(['user_id','scenario','timestamp','role','message','free_used','daily_requests','interview_stage'])
-        try:
-            states_sheet = ss.worksheet('States')
-        except Exception:
-            states_sheet = ss.add_worksheet(title='States', rows=5000, cols=10)
-            states_sheet.append_row(['user_id','state_json','updated_at','last_activity_at'])
-        # Funnel sheet
-        try:
-            funnel_sheet = ss.worksheet('Funnel')
-        except Exception:
-            funnel_sheet = ss.add_worksheet(title='Funnel', rows=5000, cols=12)
-            funnel_sheet.append_row(['timestamp','user_id','event','scenario','utm_source','utm_medium','utm_campaign','utm_content','utm_term','ad_id','extra'])
-        # Ensure States header is correct (non-destructive)
-        try:
-            s_headers = states_sheet.row_values(1)
-            needed = ['user_id','state_json','updated_at','last_activity_at']
-            if s_headers != needed:
-                states_sheet.update('A1:D1', [needed])
-        except Exception:
-            pass
-        logger.info('Google Sheets connected')
-    except Exception as e:
-        logger.warning(f"Google Sheets error: {e}")
-        users_sheet = None
-        history_sheet = None
-        states_sheet = None
+        users_sheet = ss.worksheet('Users')
+    except Exception:
+        users_sheet = ss.add_worksheet(title='Users', rows=1000, cols=20)
+        users_sheet.append_row(USERS_COLUMNS)
+    # Ensure Users header includes UTM columns (non-destructive append)
+    try:
+        u_headers = users_sheet.row_values(1)
+        needed_base = ['user_id','interview_stage','interview_answers','daily_requests','last_date','custom_limit','is_active','created_at']
+        needed_extra = ['scenario','free_used','utm_source','utm_medium','utm_campaign','utm_content','utm_term','ad_id','is_subscribed','subscription_until','last_payment_id']
+        needed = needed_base + needed_extra
+        if u_headers != needed:
+            users_sheet.update('A1', [needed])
+    except Exception:
+        pass
+    try:
+        history_sheet = ss.worksheet('History')
+    except Exception:
+        history_sheet = ss.add_worksheet(title='History', rows=5000, cols=10)
+        history_sheet.append_row(HISTORY_COLUMNS)
+    try:
+        states_sheet = ss.worksheet('States')
+    except Exception:
+        states_sheet = ss.add_worksheet(title='States', rows=5000, cols=10)
+        states_sheet.append_row(['user_id','state_json','updated_at','last_activity_at'])
+    # Funnel sheet
+    try:
+        funnel_sheet = ss.worksheet('Funnel')
+    except Exception:
+        funnel_sheet = ss.add_worksheet(title='Funnel', rows=5000, cols=12)
+        funnel_sheet.append_row(['timestamp','user_id','event','scenario','utm_source','utm_medium','utm_campaign','utm_content','utm_term','ad_id','extra'])
+    # Ensure States header is correct (non-destructive)
+    try:
+        s_headers = states_sheet.row_values(1)
+        needed = ['user_id','state_json','updated_at','last_activity_at']
+        if s_headers != needed:
+            states_sheet.update('A1:D1', [needed])
+    except Exception:
+        pass
+    return users_sheet, history_sheet, states_sheet, funnel_sheet
 
 # === СОСТОЯНИЕ ПРИЛОЖЕНИЯ ===
 user_states = {}
@@ -161,6 +254,345 @@ admin_settings = {
     'echo_user_messages': False,
 }
 
+# === МЕТРИКИ (Prometheus text format) ===
+def _label_str(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for n, v in zip(names, values):
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{n}="{v}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for lv, v in sorted(self.values.items()):
+            out.append(f"{self.name}{_label_str(self.labels, lv)} {v}")
+        return out
+
+class Histogram:
+    """Гистограмма с фиксированными бакетами: observe - bisect и три сложения."""
+
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [counts по бакетам (+Inf последним), sum, count]
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        s = self.series.get(label_values)
+        if s is None:
+            s = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        s[0][bisect.bisect_left(self.buckets, value)] += 1
+        s[1] += value
+        s[2] += 1
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ('le',)
+        for lv, (counts, total, count) in sorted(self.series.items()):
+            acc = 0
+            for bound, c in zip(self.buckets + ('+Inf',), counts):
+                acc += c
+                out.append(f"{self.name}_bucket{_label_str(names, lv + (bound,))} {acc}")
+            out.append(f"{self.name}_sum{_label_str(self.labels, lv)} {total}")
+            out.append(f"{self.name}_count{_label_str(self.labels, lv)} {count}")
+        return out
+
+class CallbackMetric:
+    """Значение читается при выгрузке: fn() -> число или {label values: число}."""
+
+    def __init__(self, name: str, kind: str, help_text: str, fn, labels: tuple = ()):
+        self.name, self.kind, self.help, self.fn, self.labels = name, kind, help_text, fn, labels
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.warning(f"Metric {self.name} error: {e}")
+            return out
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for lv, v in sorted(items):
+            out.append(f"{self.name}{_label_str(self.labels, lv)} {v}")
+        return out
+
+class MetricsRegistry:
+    """Метрики процесса для /metrics. Всё в памяти, запись без блокировок (один event loop)."""
+
+    def __init__(self):
+        self._metrics: list = []
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Counter:
+        return self._add(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def gauge_fn(self, name: str, help_text: str, fn, labels: tuple = ()) -> CallbackMetric:
+        return self._add(CallbackMetric(name, 'gauge', help_text, fn, labels))
+
+    def counter_fn(self, name: str, help_text: str, fn, labels: tuple = ()) -> CallbackMetric:
+        return self._add(CallbackMetric(name, 'counter', help_text, fn, labels))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+update_latency = metrics.histogram('bot_update_latency_seconds', 'Webhook receipt to handler completion')
+deepseek_duration = metrics.histogram('bot_deepseek_request_seconds', 'DeepSeek request duration incl. retries and body', ('mode', 'outcome'))
+sheets_duration = metrics.histogram('bot_sheets_call_seconds', 'Blocking (gspread) call duration', ('worksheet', 'op'))
+messages_total = metrics.counter('bot_messages_total', 'User text messages by scenario', ('scenario',))
+limit_hits_total = metrics.counter('bot_limit_hits_total', 'Messages rejected by a usage limit', ('kind',))
+payments_total = metrics.counter('bot_payments_total', 'Successful payments', ('provider',))
+
+# === ТРАССИРОВКА ===
+class Trace:
+    """Трасса одного апдейта: корневой интервал и плоский список дочерних (внешние вызовы)."""
+
+    __slots__ = ('id', 'started_at', 't0', 'attrs', 'spans', 'duration', 'error')
+
+    def __init__(self, attrs: dict):
+        self.id = uuid.uuid4().hex[:12]
+        self.started_at = time.time()
+        self.t0 = time.monotonic()
+        self.attrs = attrs
+        # [name, start offset, duration, attrs, error]
+        self.spans: list[list] = []
+        self.duration = None
+        self.error = None
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'ts': round(self.started_at, 3),
+            'duration_ms': round((self.duration or 0) * 1000, 1),
+            'error': self.error,
+            **self.attrs,
+            'spans': [
+                {'name': n, 'start_ms': round(off * 1000, 1), 'duration_ms': round(d * 1000, 1), **a, **({'error': e} if e else {})}
+                for n, off, d, a, e in self.spans
+            ],
+        }
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('current_trace', default=None)
+
+class Tracer:
+    """Трассирует каждый апдейт, а решение о сохранении принимает в конце (tail sampling).
+
+    Медленные (>= slow_secs) и упавшие трассы сохраняются всегда, остальные - с вероятностью
+    sample_rate. Сохранённые попадают в кольцевой буфер (/traces) и, если задан путь, в JSONL:
+    строки копятся в буфере и дописываются фоновой задачей через пул blocking.
+    Интервалы, закончившиеся после end() (задачи, порождённые внутри апдейта), отбрасываются.
+    """
+
+    def __init__(self, sample_rate: float, slow_secs: float, ring_size: int, path: str = '',
+                 flush_secs: float = 1.0):
+        self.sample_rate = sample_rate
+        self.slow_secs = slow_secs
+        self.ring: deque[Trace] = deque(maxlen=max(1, ring_size))
+        self.path = path
+        self.flush_secs = flush_secs
+        self._fh = None
+        self._pending: list[str] = []
+        self._task: asyncio.Task | None = None
+        self.finished = 0
+        self.late_spans = 0
+
+    def begin(self, **attrs):
+        trace = Trace(attrs)
+        return trace, _current_trace.set(trace)
+
+    def end(self, trace: Trace, token, error: str | None = None):
+        _current_trace.reset(token)
+        trace.duration = time.monotonic() - trace.t0
+        trace.error = error or next((sp[4] for sp in trace.spans if sp[4]), None)
+        self.finished += 1
+        if trace.duration >= self.slow_secs or trace.error or random.random() < self.sample_rate:
+            self.ring.append(trace)
+            if self.path:
+                self._pending.append(json.dumps(trace.to_dict(), ensure_ascii=False) + '\n')
+                if self._task is None:
+                    self._task = asyncio.create_task(self._run())
+
+    def find(self, trace_id: str) -> Trace | None:
+        return next((t for t in self.ring if t.id == trace_id), None)
+
+    async def stop(self):
+        """Останавливает фоновую запись, дописав буфер, и закрывает JSONL."""
+        task, self._task = self._task, None
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        await blocking.run('Traces', self._close)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_secs)
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        lines, self._pending = self._pending, []
+        try:
+            await blocking.run('Traces', self._append, lines)
+        except Exception as e:
+            # трассы - диагностика: при ошибке диска пачку не копим, а теряем
+            logger.warning(f"Trace write error ({len(lines)} traces): {e}")
+
+    def _append(self, lines: list[str]):
+        if self._fh is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._fh = open(self.path, 'a', encoding='utf-8')
+        self._fh.write(''.join(lines))
+        self._fh.flush()
+
+    def _close(self):
+        if self._fh:
+            try:
+                self._fh.close()
+            except Exception:
+                pass
+            self._fh = None
+
+tracer = Tracer(TRACE_SAMPLE_RATE, TRACE_SLOW_SECS, TRACE_RING_SIZE, TRACE_JSONL_PATH)
+
+@contextlib.contextmanager
+def trace_span(name: str, **attrs):
+    """Дочерний интервал текущей трассы (отдаёт его attrs для дополнения); вне трассы ничего не делает."""
+    trace = _current_trace.get()
+    if trace is not None and trace.duration is not None:
+        # фоновая задача, порождённая апдейтом, пережила его трассу: та уже сэмплирована и записана
+        tracer.late_spans += 1
+        trace = None
+    if trace is None:
+        yield attrs
+        return
+    started = time.monotonic()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"[:200]
+        raise
+    finally:
+        if trace.duration is None:
+            trace.spans.append([name, started - trace.t0, time.monotonic() - started, attrs, error])
+        else:
+            tracer.late_spans += 1
+
+class TracedHTTPXRequest(HTTPXRequest):
+    """Запросы PTB к Bot API: каждый вызов (sendMessage, editMessageText...) - интервал трассы."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        with trace_span(f"tg.{url.rsplit('/', 1)[-1]}") as span:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            span['status'] = code
+            return code, payload
+
+# === БЛОКИРУЮЩИЕ ВЫЗОВЫ (gspread, YooKassa SDK) ===
+class BlockingExecutor:
+    """Ограниченный пул потоков для синхронных клиентов (gspread, YooKassa SDK).
+
+    Вызовы с одним ключом (лист таблицы) выполняются строго по очереди, чтобы сохранить порядок записей.
+    Считает глубину очереди и латентность по ключу/операции.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='blocking')
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.pending = 0
+        self.running = 0
+        # "key.op" -> [count, errors, total_secs, max_secs]
+        self.stats: dict[str, list] = {}
+
+    @property
+    def queue_depth(self) -> int:
+        return self.pending - self.running
+
+    async def run(self, key: str, fn, *args, serial: bool = True):
+        self.pending += 1
+        try:
+            if not serial:
+                return await self._call(key, fn, args)
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = asyncio.Lock()
+            async with lock:
+                return await self._call(key, fn, args)
+        finally:
+            self.pending -= 1
+
+    def spawn(self, key: str, fn, *args, serial: bool = True) -> asyncio.Task:
+        """Запускает вызов в фоне (fire-and-forget); ошибки только логируются."""
+        task = asyncio.create_task(self.run(key, fn, *args, serial=serial))
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.warning(f"Background sync call error: {task.exception()}")
+
+    async def _call(self, key: str, fn, args):
+        loop = asyncio.get_running_loop()
+        op = getattr(fn, '__name__', 'call')
+        name = f"{key}.{op}"
+        started = time.monotonic()
+        self.running += 1
+        failed = False
+        try:
+            with trace_span(f"sheets.{name}"):
+                return await loop.run_in_executor(self._pool, functools.partial(fn, *args))
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.running -= 1
+            elapsed = time.monotonic() - started
+            sheets_duration.observe(elapsed, key, op)
+            st = self.stats.get(name)
+            if st is None:
+                st = self.stats[name] = [0, 0, 0.0, 0.0]
+            st[0] += 1
+            st[1] += int(failed)
+            st[2] += elapsed
+            st[3] = max(st[3], elapsed)
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+blocking = BlockingExecutor(SYNC_POOL_SIZE)
+
 # === Подписка/оплата утилиты ===
 def is_subscription_active(state: dict) -> bool:
     try:
@@ -213,72 +645,148 @@ async def send_invoice_to_user(context: ContextTypes.DEFAULT_TYPE, user_id: int)
         provider_data=json.dumps(provider_data, ensure_ascii=False)
     )
 
+# === YooKassa (async API client) ===
+class YooKassaError(Exception):
+    pass
+
+class YooKassaClient:
+    """Минимальный асинхронный клиент YooKassa API v3 поверх общего пула aiohttp."""
+
+    def __init__(self, account_id: str, secret_key: str, base_url: str = YOOKASSA_API_URL):
+        self.auth = aiohttp.BasicAuth(account_id, secret_key)
+        self.base_url = base_url
+
+    async def _request(self, method: str, path: str, payload: dict | None = None) -> dict:
+        session = await open_http_session()
+        headers = {}
+        if method == 'POST':
+            headers['Idempotence-Key'] = str(uuid.uuid4())
+        with trace_span(f"yookassa.{method} {path}") as span:
+            async with session.request(
+                method,
+                f"{self.base_url}{path}",
+                json=payload,
+                auth=self.auth,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=20, sock_connect=5),
+            ) as response:
+                span['status'] = response.status
+                body = await response.json(content_type=None)
+                if response.status >= 400:
+                    raise YooKassaError(f"{response.status}: {(body or {}).get('description') or body}")
+                return body
+
+    async def create_invoice(self, payload: dict) -> dict:
+        return await self._request('POST', '/invoices', payload)
+
+    async def create_payment(self, payload: dict) -> dict:
+        return await self._request('POST', '/payments', payload)
+
+yookassa_client: YooKassaClient | None = None
+
+def init_yookassa():
+    """Создаёт клиент YooKassa при старте (до этого ссылки на оплату «временно недоступны»)."""
+    global yookassa_client
+    if YOOKASSA_ACCOUNT_ID and YOOKASSA_SECRET_KEY:
+        yookassa_client = YooKassaClient(YOOKASSA_ACCOUNT_ID, YOOKASSA_SECRET_KEY)
+
+# (user_id, price) -> (invoice_id, url, expires_at UTC)
+invoice_cache: dict[tuple[int, str], tuple[str, str, datetime]] = {}
+
+def cached_invoice(user_id: int, price: str) -> tuple[str, str] | None:
+    """Ещё действующий счёт пользователя на эту сумму (из кэша или из state после рестарта)."""
+    entry = invoice_cache.get((user_id, price))
+    if entry is None:
+        st = user_states.get(user_id) or {}
+        if st.get('last_invoice_id') and st.get('last_invoice_url') and st.get('last_invoice_price') == price:
+            try:
+                expires = datetime.strptime(st.get('last_invoice_expires_at', ''), '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+                entry = invoice_cache[(user_id, price)] = (st['last_invoice_id'], st['last_invoice_url'], expires)
+            except Exception:
+                return None
+    if entry is None:
+        return None
+    inv_id, url, expires = entry
+    if datetime.now(timezone.utc) + timedelta(minutes=YOOKASSA_INVOICE_REUSE_MARGIN_MIN) >= expires:
+        invoice_cache.pop((user_id, price), None)
+        return None
+    return inv_id, url
+
+def forget_invoices(user_id: int):
+    for key in [k for k in invoice_cache if k[0] == user_id]:
+        invoice_cache.pop(key, None)
+    st = user_states.get(user_id)
+    if st:
+        st['last_invoice_url'] = ''
+
 async def send_sbp_link(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    if not (YOOKASSA_ACCOUNT_ID and YOOKASSA_SECRET_KEY):
+    if not yookassa_client:
         return
     try:
-        try:
-            from yookassa.invoice import Invoice as YKInvoice  # lazy import
-        except Exception:
-            return
-        # Не запрашиваем e-mail на нашей стороне; используем только позиции чека и систему налогообложения.
-        # Создаём счёт (Invoice) без сбора персональных данных, передаём telegram_user_id в metadata
-        expires_at = (datetime.utcnow() + timedelta(hours=24)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
-        payload = {
-            "payment_data": {
-                "amount": {"value": f"{VLASTA_PRICE_RUB:.2f}", "currency": "RUB"},
-                "capture": True,
-                "description": "Vlasta - доступ на 7 дней",
+        price = f"{VLASTA_PRICE_RUB:.2f}"
+        cached = cached_invoice(chat_id, price)
+        if cached:
+            inv_id, url = cached
+            logger.info(f"YooKassa Invoice reused: id={inv_id}")
+        else:
+            # Не запрашиваем e-mail на нашей стороне; используем только позиции чека и систему налогообложения.
+            # Создаём счёт (Invoice) без сбора персональных данных, передаём telegram_user_id в metadata
+            expires_dt = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(hours=YOOKASSA_INVOICE_TTL_HOURS)
+            expires_at = expires_dt.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            payload = {
+                "payment_data": {
+                    "amount": {"value": f"{VLASTA_PRICE_RUB:.2f}", "currency": "RUB"},
+                    "capture": True,
+                    "description": "Vlasta - доступ на 7 дней",
+                    "metadata": {
+                        "telegram_user_id": str(chat_id),
+                        "scenario": user_states.get(chat_id, {}).get('scenario', 'Vlasta')
+                    },
+                    # Добавляем данные для формирования фискального чека (54‑ФЗ)
+                    "receipt": {
+                        "items": [
+                            {
+                                "description": "Доступ к Vlasta на 7 дней",
+                                "quantity": "1.0",
+                                "amount": {"value": f"{VLASTA_PRICE_RUB:.2f}", "currency": "RUB"},
+                                "vat_code": VAT_CODE,
+                                "payment_mode": "full_payment",
+                                "payment_subject": "service"
+                            }
+                        ],
+                        "tax_system_code": TAX_SYSTEM_CODE
+                    }
+                },
+                "cart": [
+                    {
+                        "description": "Доступ к Vlasta на 7 дней",
+                        "price": {"value": f"{VLASTA_PRICE_RUB:.2f}", "currency": "RUB"},
+                        "quantity": 1.000
+                    }
+                ],
+                "delivery_method_data": {"type": "self"},
+                "locale": "ru_RU",
+                "expires_at": expires_at,
+                "description": "Счёт на 7‑дневный доступ Vlasta",
                 "metadata": {
                     "telegram_user_id": str(chat_id),
                     "scenario": user_states.get(chat_id, {}).get('scenario', 'Vlasta')
-                },
-                # Добавляем данные для формирования фискального чека (54‑ФЗ)
-                "receipt": {
-                    "items": [
-                        {
-                            "description": "Доступ к Vlasta на 7 дней",
-                            "quantity": "1.0",
-                            "amount": {"value": f"{VLASTA_PRICE_RUB:.2f}", "currency": "RUB"},
-                            "vat_code": VAT_CODE,
-                            "payment_mode": "full_payment",
-                            "payment_subject": "service"
-                        }
-                    ],
-                    "tax_system_code": TAX_SYSTEM_CODE
-                }
-            },
-            "cart": [
-                {
-                    "description": "Доступ к Vlasta на 7 дней",
-                    "price": {"value": f"{VLASTA_PRICE_RUB:.2f}", "currency": "RUB"},
-                    "quantity": 1.000
                 }
-            ],
-            "delivery_method_data": {"type": "self"},
-            "locale": "ru_RU",
-            "expires_at": expires_at,
-            "description": "Счёт на 7‑дневный доступ Vlasta",
-            "metadata": {
-                "telegram_user_id": str(chat_id),
-                "scenario": user_states.get(chat_id, {}).get('scenario', 'Vlasta')
             }
-        }
-        idem = str(uuid.uuid4())
-        inv = YKInvoice.create(payload, idem)
-        url = None
-        try:
-            if inv and getattr(inv, 'delivery_method', None):
-                url = getattr(inv.delivery_method, 'url', None)
-        except Exception:
-            url = None
-        inv_id = getattr(inv, 'id', '-')
-        try:
-            st = user_states.setdefault(chat_id, {})
-            st['last_invoice_id'] = inv_id
-        except Exception:
-            pass
-        logger.info(f"YooKassa Invoice created: id={inv_id} url={url}")
+            inv = await yookassa_client.create_invoice(payload)
+            url = (inv.get('delivery_method') or {}).get('url')
+            inv_id = inv.get('id', '-')
+            try:
+                st = user_states.setdefault(chat_id, {})
+                st['last_invoice_id'] = inv_id
+                if url:
+                    st['last_invoice_url'] = url
+                    st['last_invoice_price'] = price
+                    st['last_invoice_expires_at'] = expires_dt.strftime('%Y-%m-%dT%H:%M:%S')
+                    invoice_cache[(chat_id, price)] = (inv_id, url, expires_dt)
+            except Exception:
+                pass
+            logger.info(f"YooKassa Invoice created: id={inv_id} url={url}")
         if url:
             kb = InlineKeyboardMarkup([[InlineKeyboardButton(text="Оплатить по СБП", url=url)]])
             await context.bot.send_message(chat_id=chat_id, text="Сформирован персональный счёт. Нажми кнопку, чтобы оплатить по СБП:", reply_markup=kb)
@@ -297,13 +805,32 @@ async def send_sbp_link(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
         return
 
 # === PERSISTENCE (Sheets) ===
+def appended_start_row(resp) -> int | None:
+    """Номер первой строки, записанной append_row(s), по updatedRange ответа (например "'States'!A5:D6")."""
+    try:
+        updated_range = ((resp or {}).get('updates') or {}).get('updatedRange') or ''
+        m = re.search(r'![A-Z]+(\d+)', updated_range)
+        return int(m.group(1)) if m else None
+    except Exception:
+        return None
+
 class SheetsPersistence:
     def __init__(self, sheet):
         self.sheet = sheet
         self.user_row_cache: dict[int, int] = {}
-        self.last_saved_at: dict[int, float] = {}
-        self.debounce_secs: float = float(os.environ.get('SAVE_DEBOUNCE_SECS', '5'))
+        # next free row (row 1 is header); moved forward locally on every append
+        self.next_row: int = 2
+        self.reconcile_secs: float = float(os.environ.get('STATES_RECONCILE_SECS', '900'))
+        self.last_reconcile_at: float = time.monotonic()
         self.expected_headers = ['user_id','state_json','updated_at','last_activity_at']
+        # user_id -> (state_json, updated_at), ждут записи фоновым флашером
+        self.dirty: dict[int, tuple[str, str]] = {}
+        self.flush_secs: float = float(os.environ.get('STATE_FLUSH_SECS', os.environ.get('SAVE_DEBOUNCE_SECS', '5')))
+        self._dirty_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._closing = False
 
     def _ensure_cache(self):
         if not self.sheet:
@@ -319,69 +846,228 @@ class SheetsPersistence:
                         self.user_row_cache[int(str(uid))] = idx
                     except Exception:
                         pass
+            self.next_row = len(records) + 2
         except Exception as e:
             logger.warning(f"States cache build error: {e}")
 
+    def _index_appended(self, rows: list[list], resp):
+        """Дописывает в индекс строки после append_rows без перечитывания листа.
+
+        Номер первой строки берём из updatedRange ответа API, иначе из локального счётчика next_row.
+        """
+        start = appended_start_row(resp) or self.next_row
+        for offset, row in enumerate(rows):
+            self.user_row_cache[int(row[0])] = start + offset
+        self.next_row = max(self.next_row, start + len(rows))
+
+    def reconcile_index(self):
+        """Сверка индекса строк по одной колонке user_id (дёшево, без state_json). Запускается по расписанию."""
+        if not self.sheet:
+            return
+        with self._flush_lock:
+            try:
+                ids = self.sheet.col_values(1)
+            except Exception as e:
+                logger.warning(f"States reconcile error: {e}")
+                return
+            cache: dict[int, int] = {}
+            # row 1 is header
+            for idx, uid in enumerate(ids[1:], start=2):
+                try:
+                    cache[int(str(uid))] = idx
+                except Exception:
+                    pass
+            drift = sum(1 for uid, row in cache.items() if self.user_row_cache.get(uid) != row)
+            if drift:
+                logger.warning(f"States index reconciled: {drift} rows drifted")
+            self.user_row_cache = cache
+            self.next_row = len(ids) + 1
+            self.last_reconcile_at = time.monotonic()
+
     def load_all_states(self) -> dict[int, dict]:
+        """Одно чтение листа: по нему строятся и состояния, и индекс строк user_id -> номер строки.
+
+        Ошибку чтения пробрасывает: пустой результат не должен выглядеть как «пользователей нет».
+        """
         data: dict[int, dict] = {}
         if not self.sheet:
             return data
-        try:
-            records = self.sheet.get_all_records(expected_headers=self.expected_headers)
-            for rec in records:
-                uid = rec.get('user_id')
-                state_json = rec.get('state_json')
-                if uid is None or not state_json:
+        with self._flush_lock:
+            values = self.sheet.get_all_values()
+            cache: dict[int, int] = {}
+            # row 1 is header; columns: user_id, state_json, updated_at, last_activity_at
+            for idx, row in enumerate(values[1:], start=2):
+                try:
+                    uid = int(str(row[0]))
+                except Exception:
                     continue
+                cache[uid] = idx
+                if len(row) > 1 and row[1]:
+                    try:
+                        data[uid] = json_loads(row[1])
+                    except Exception:
+                        continue
+            self.user_row_cache = cache
+            self.next_row = len(values) + 1
+            self.last_reconcile_at = time.monotonic()
+        return data
+
+    def load_changed_since(self, since: str) -> dict[int, dict]:
+        """Сверка с локальным снимком: state_json только тех строк, у которых updated_at >= since.
+
+        Колонки user_id и updated_at читаются одним batch_get (заодно пересобирается индекс строк),
+        state_json изменённых строк - вторым: соседние строки склеиваются в блоки B{a}:B{b}, а если
+        блоков больше STATE_SNAPSHOT_MAX_BLOCKS, колонка B читается целиком. Нужные строки выбираются локально.
+        """
+        if not self.sheet:
+            return {}
+        with self._flush_lock:
+            ids, stamps = self.sheet.batch_get(['A:A', 'C:C'])
+            cache: dict[int, int] = {}
+            changed: list[tuple[int, int]] = []
+            # row 1 is header
+            for idx, cell in enumerate(ids[1:], start=2):
                 try:
-                    uid_int = int(str(uid))
-                    state = json.loads(state_json)
-                    data[uid_int] = state
+                    uid = int(str(cell[0]))
                 except Exception:
                     continue
-            # build cache too
-            self._ensure_cache()
-        except Exception as e:
-            logger.warning(f"States load error: {e}")
+                cache[uid] = idx
+                stamp = stamps[idx - 1] if idx - 1 < len(stamps) else []
+                if stamp and str(stamp[0]) >= since:
+                    changed.append((uid, idx))
+            self.user_row_cache = cache
+            self.next_row = len(ids) + 1
+            self.last_reconcile_at = time.monotonic()
+            if not changed:
+                return {}
+            # changed идёт по возрастанию строк
+            blocks: list[list[int]] = []
+            for _, row in changed:
+                if blocks and row - blocks[-1][1] <= STATE_SNAPSHOT_BLOCK_GAP + 1:
+                    blocks[-1][1] = row
+                else:
+                    blocks.append([row, row])
+            cells_by_row: dict[int, list] = {}
+            if len(blocks) <= STATE_SNAPSHOT_MAX_BLOCKS:
+                for (first, _), values in zip(blocks, self.sheet.batch_get([f'B{a}:B{b}' for a, b in blocks])):
+                    for offset, cells in enumerate(values):
+                        cells_by_row[first + offset] = cells
+            else:
+                logger.info(f"States changed since snapshot: {len(changed)} rows in {len(blocks)} blocks, reading column B")
+                for idx, cells in enumerate(self.sheet.batch_get(['B:B'])[0], start=1):
+                    cells_by_row[idx] = cells
+        data: dict[int, dict] = {}
+        for uid, row in changed:
+            try:
+                data[uid] = json_loads(cells_by_row[row][0])
+            except Exception:
+                continue
         return data
 
     def save_user_state(self, user_id: int, state: dict, force: bool = False):
+        """Помечает пользователя «грязным»; запись делает фоновый флашер одним batch_update.
+
+        force=True будит флашер сразу (или пишет синхронно, если флашер не запущен).
+        """
         if not self.sheet:
             return
-        now = datetime.now(MSK_TZ)
-        now_ts = now.strftime('%Y-%m-%d %H:%M:%S')
-        last = self.last_saved_at.get(user_id, 0)
-        if not force and (asyncio.get_event_loop().time() - last) < self.debounce_secs:
-            return
+        now_ts = datetime.now(MSK_TZ).strftime('%Y-%m-%d %H:%M:%S')
         try:
             state_copy = dict(state)
-            # Ensure serializable
-            if 'conversation_history' in state_copy:
-                # history not needed in persisted state to save space
-                state_copy.pop('conversation_history', None)
+            # history not needed in persisted state to save space
+            state_copy.pop('conversation_history', None)
             state_json = json.dumps(state_copy, ensure_ascii=False, separators=(',', ':'))
-            row_idx = self.user_row_cache.get(user_id)
-            if row_idx:
-                # update
-                self.sheet.update_cell(row_idx, 2, state_json)
-                self.sheet.update_cell(row_idx, 3, now_ts)
-                self.sheet.update_cell(row_idx, 4, now_ts)
+        except Exception as e:
+            logger.warning(f"States serialize error: {e}")
+            return
+        with self._dirty_lock:
+            self.dirty[user_id] = (state_json, now_ts)
+        if force:
+            if self._wakeup:
+                self._wakeup.set()
             else:
-                # append
-                self.sheet.append_row([user_id, state_json, now_ts, now_ts])
-                # refresh cache entry (new row is at bottom)
-                self._ensure_cache()
-            self.last_saved_at[user_id] = asyncio.get_event_loop().time()
+                self.flush_dirty()
+
+    def flush_dirty(self) -> int:
+        """Пишет всех «грязных» пользователей: обновления одним batch_update, новые строки одним append_rows."""
+        if not self.sheet:
+            return 0
+        with self._flush_lock:
+            with self._dirty_lock:
+                dirty, self.dirty = self.dirty, {}
+            if not dirty:
+                return 0
+            updates = []
+            new_rows = []
+            for uid, (state_json, ts) in dirty.items():
+                row_idx = self.user_row_cache.get(uid)
+                if row_idx:
+                    updates.append({'range': f'B{row_idx}:D{row_idx}', 'values': [[state_json, ts, ts]]})
+                else:
+                    new_rows.append([uid, state_json, ts, ts])
+            try:
+                if updates:
+                    self.sheet.batch_update(updates)
+                if new_rows:
+                    resp = self.sheet.append_rows(new_rows)
+                    self._index_appended(new_rows, resp)
+            except Exception as e:
+                logger.warning(f"States flush error ({len(dirty)} users): {e}")
+                # вернём в очередь, не затирая более свежие изменения
+                with self._dirty_lock:
+                    for uid, item in dirty.items():
+                        self.dirty.setdefault(uid, item)
+                return 0
+            return len(dirty)
+
+    def start(self):
+        if self._task:
+            return
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает флашер, предварительно записав всех «грязных» пользователей."""
+        task = self._task
+        if not task:
+            return
+        self._task = None
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await task
         except Exception as e:
-            logger.warning(f"States save error: {e}")
+            logger.warning(f"States flusher stop error: {e}")
+        self._wakeup = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_secs)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self.dirty:
+                await blocking.run('States', self.flush_dirty)
+            if self._closing:
+                return
+            if time.monotonic() - self.last_reconcile_at >= self.reconcile_secs:
+                self.last_reconcile_at = time.monotonic()
+                await blocking.run('States', self.reconcile_index)
 
     def flush_all(self, states: dict[int, dict]):
         for uid, st in states.items():
-            self.save_user_state(uid, st, force=True)
+            self.save_user_state(uid, st)
+        self.flush_dirty()
 
     def prune_old(self, days: int = 14):
         if not self.sheet:
             return 0
+        with self._flush_lock:
+            return self._prune_old_locked(days)
+
+    def _prune_old_locked(self, days: int) -> int:
         removed = 0
         try:
             records = self.sheet.get_all_records(expected_headers=self.expected_headers)
@@ -400,91 +1086,790 @@ class SheetsPersistence:
                     continue
         except Exception as e:
             logger.warning(f"States prune error: {e}")
+        if removed:
+            # row numbers shifted after delete_rows
+            self._ensure_cache()
         return removed
 
-persistence = SheetsPersistence(states_sheet) if states_sheet else None
+# === PERSISTENCE (SQLite) ===
+class SQLitePersistence:
+    """Локальное хранилище в SQLite (WAL) с тем же интерфейсом, что и SheetsPersistence.
 
-# === USERS sheet helpers ===
-def save_interview_answers_to_users(user_id: int, state: dict):
-    if not users_sheet:
-        return
-    try:
-        headers = users_sheet.row_values(1)
-        if not headers:
-            return
+    Состояния, History и Users пишутся синхронно в локальную БД (микросекунды),
+    а Google Sheets (mirror) получает те же состояния асинхронно через свой флашер.
+    """
+
+    def __init__(self, path: str, mirror: SheetsPersistence | None = None):
+        self.path = path
+        self.mirror = mirror
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS states ('
+                'user_id INTEGER PRIMARY KEY, state_json TEXT NOT NULL, updated_at TEXT, last_activity_at TEXT)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS states_last_activity ON states(last_activity_at)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                + ', '.join(f'{c} {"INTEGER" if c == "user_id" else "TEXT"}' for c in HISTORY_COLUMNS) + ')'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS history_user ON history(user_id, id)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, '
+                + ', '.join(f'{c} TEXT' for c in USERS_COLUMNS[1:]) + ')'
+            )
+        logger.info(f"SQLite storage: {path}")
+
+    def load_all_states(self) -> dict[int, dict]:
+        data: dict[int, dict] = {}
         try:
-            interview_col = headers.index('interview_answers') + 1
-        except ValueError:
-            return
-        records = users_sheet.get_all_records()
-        row_idx = None
-        for idx, rec in enumerate(records, start=2):
-            if str(rec.get('user_id')) == str(user_id):
-                row_idx = idx
-                break
-        if not row_idx:
-            return
-        answers = state.get('interview_answers') or []
-        numbered = "\n".join([f"{i+1}. {a}" for i, a in enumerate(answers)])
-        users_sheet.update_cell(row_idx, interview_col, numbered)
-    except Exception:
-        # fail silent to not break dialog
-        pass
+            with self._lock:
+                rows = self.conn.execute('SELECT user_id, state_json FROM states').fetchall()
+            for uid, state_json in rows:
+                try:
+                    data[int(uid)] = json.loads(state_json)
+                except Exception:
+                    continue
+        except Exception as e:
+            logger.warning(f"SQLite states load error: {e}")
+        if not data and self.mirror:
+            # первая загрузка: переносим состояния из Sheets
+            data = self.mirror.load_all_states()
+            for uid, st in data.items():
+                self._write_state(uid, st)
+            logger.info(f"SQLite seeded from Sheets: {len(data)} states")
+        elif self.mirror:
+            # mirror нужен только индекс строк, состояния уже есть локально
+            self.mirror.reconcile_index()
+        return data
 
-def update_user_subscription_in_sheet(user_id: int, state: dict):
-    """Обновляет данные подписки пользователя в таблице Users"""
-    if not users_sheet:
-        return
-    try:
-        headers = users_sheet.row_values(1)
-        if not headers:
-            return
-        
-        # Находим индексы колонок
+    def _write_state(self, user_id: int, state: dict):
+        now_ts = datetime.now(MSK_TZ).strftime('%Y-%m-%d %H:%M:%S')
+        state_copy = dict(state)
+        state_copy.pop('conversation_history', None)
+        state_json = json.dumps(state_copy, ensure_ascii=False, separators=(',', ':'))
+        last_at = state.get('last_activity_at') or now_ts
+        with self._lock:
+            self.conn.execute(
+                'INSERT INTO states(user_id, state_json, updated_at, last_activity_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET state_json=excluded.state_json, '
+                'updated_at=excluded.updated_at, last_activity_at=excluded.last_activity_at',
+                (user_id, state_json, now_ts, last_at),
+            )
+
+    def save_user_state(self, user_id: int, state: dict, force: bool = False):
         try:
-            is_sub_col = headers.index('is_subscribed') + 1
-            until_col = headers.index('subscription_until') + 1
-            payment_col = headers.index('last_payment_id') + 1
-        except ValueError:
-            return
-        
-        # Находим строку пользователя
-        records = users_sheet.get_all_records()
-        row_idx = None
-        for idx, rec in enumerate(records, start=2):
-            if str(rec.get('user_id')) == str(user_id):
-                row_idx = idx
-                break
+            self._write_state(user_id, state)
+        except Exception as e:
+            logger.warning(f"SQLite save error: {e}")
+        if self.mirror:
+            self.mirror.save_user_state(user_id, state, force=force)
+
+    def flush_all(self, states: dict[int, dict]):
+        for uid, st in states.items():
+            self.save_user_state(uid, st)
+        if self.mirror:
+            self.mirror.flush_dirty()
+
+    def prune_old(self, days: int = 14):
+        cutoff = (datetime.now(MSK_TZ) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        removed = 0
+        try:
+            with self._lock:
+                removed = self.conn.execute('DELETE FROM states WHERE last_activity_at < ?', (cutoff,)).rowcount
+        except Exception as e:
+            logger.warning(f"SQLite prune error: {e}")
+        if self.mirror:
+            self.mirror.prune_old(days)
+        return removed
+
+    def append_history(self, row: list):
+        try:
+            with self._lock:
+                self.conn.execute(
+                    f'INSERT INTO history({", ".join(HISTORY_COLUMNS)}) VALUES ({", ".join("?" * len(HISTORY_COLUMNS))})',
+                    row,
+                )
+        except Exception as e:
+            logger.warning(f"SQLite history write error: {e}")
+
+    def recent_history(self, user_id: int, limit: int) -> list[dict]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT role, message FROM history WHERE user_id = ? AND role IN ('user', 'assistant') "
+                "ORDER BY id DESC LIMIT ?",
+                (user_id, limit),
+            ).fetchall()
+        return [{"role": role, "content": msg} for role, msg in reversed(rows) if msg]
+
+    def insert_user(self, row: list):
+        try:
+            with self._lock:
+                self.conn.execute(
+                    f'INSERT OR IGNORE INTO users({", ".join(USERS_COLUMNS)}) VALUES ({", ".join("?" * len(USERS_COLUMNS))})',
+                    row,
+                )
+        except Exception as e:
+            logger.warning(f"SQLite users write error: {e}")
+
+    def update_user(self, user_id: int, fields: dict):
+        cols = [c for c in fields if c in USERS_COLUMNS[1:]]
+        if not cols:
+            return
+        try:
+            with self._lock:
+                self.conn.execute(
+                    f'UPDATE users SET {", ".join(f"{c} = ?" for c in cols)} WHERE user_id = ?',
+                    [fields[c] for c in cols] + [user_id],
+                )
+        except Exception as e:
+            logger.warning(f"SQLite users update error: {e}")
+
+    def start(self):
+        if self.mirror:
+            self.mirror.start()
+
+    async def stop(self):
+        if self.mirror:
+            await self.mirror.stop()
+        try:
+            with self._lock:
+                self.conn.close()
+        except Exception:
+            pass
+
+# === PERSISTENCE (локальный снимок) ===
+class StateSnapshot:
+    """Снимок состояний пользователей на локальном диске (без conversation_history) для быстрого старта.
+
+    Пишется атомарно (tmp + os.replace) каждые STATE_SNAPSHOT_SECS и при остановке, но только после
+    успешного восстановления из Sheets, чтобы неполный user_states не затёр хороший снимок.
+    На старте состояния берутся из снимка, а из Sheets догружаются строки, изменённые после saved_at.
+    """
+
+    def __init__(self, path: str, interval: float):
+        self.path = path
+        self.interval = interval
+        # время (МСК) последнего записанного или загруженного снимка
+        self.saved_at: str | None = None
+        self.armed = False
+        self._task: asyncio.Task | None = None
+
+    def load(self) -> dict[int, dict]:
+        started = time.monotonic()
+        try:
+            with open(self.path, 'rb') as fh:
+                data = json_loads(fh.read())
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"State snapshot load error: {e}")
+            return {}
+        states: dict[int, dict] = {}
+        for uid, st in (data.get('states') or {}).items():
+            try:
+                states[int(uid)] = st
+            except ValueError:
+                continue
+        self.saved_at = data.get('saved_at')
+        logger.info(f"State snapshot loaded: {len(states)} users from {self.saved_at} "
+                    f"in {(time.monotonic() - started) * 1000:.0f} ms")
+        return states
+
+    async def save(self, states: dict[int, dict]) -> int:
+        """Сериализует состояния на event loop порциями (словари меняются хендлерами) и пишет файл в пуле."""
+        # метка берётся до сериализации: всё, что изменится позже, попадёт в Sheets с updated_at >= saved_at
+        saved_at = now_msk_str()
+        parts = []
+        for i, (uid, st) in enumerate(list(states.items()), start=1):
+            try:
+                state_copy = dict(st)
+                state_copy.pop('conversation_history', None)
+                parts.append(f'"{uid}":' + json.dumps(state_copy, ensure_ascii=False, separators=(',', ':')))
+            except Exception as e:
+                logger.warning(f"State snapshot serialize error ({uid}): {e}")
+            if i % 500 == 0:
+                await asyncio.sleep(0)
+        payload = '{"saved_at":' + json.dumps(saved_at) + ',"states":{' + ','.join(parts) + '}}'
+        await blocking.run('Snapshot', self._write, payload)
+        self.saved_at = saved_at
+        return len(parts)
+
+    def _write(self, payload: str):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            fh.write(payload)
+        os.replace(tmp, self.path)
+
+    def start(self):
+        self.armed = True
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает периодическую запись и пишет финальный снимок."""
+        task, self._task = self._task, None
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self.armed:
+            try:
+                count = await self.save(user_states)
+                logger.info(f"State snapshot saved: {count} users")
+            except Exception as e:
+                logger.warning(f"State snapshot save error: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save(user_states)
+            except Exception as e:
+                logger.warning(f"State snapshot save error: {e}")
+
+sheets_persistence: SheetsPersistence | None = None  # см. attach_sheets()
+sqlite_store: SQLitePersistence | None = None
+if STORAGE_BACKEND == 'sqlite':
+    try:
+        sqlite_store = SQLitePersistence(SQLITE_PATH)
+    except Exception as e:
+        logger.warning(f"SQLite storage error, falling back to Sheets: {e}")
+persistence = sqlite_store or sheets_persistence
+# при SQLite локальная БД уже даёт быстрый старт, снимок нужен только для Sheets
+state_snapshot: StateSnapshot | None = None
+if STATE_SNAPSHOT_SECS > 0 and not sqlite_store:
+    state_snapshot = StateSnapshot(os.path.join(LOCAL_DATA_DIR, 'states_snapshot.json'), STATE_SNAPSHOT_SECS)
+
+# === USERS sheet helpers ===
+class UsersIndex:
+    """Индекс листа Users: имя колонки -> номер колонки, user_id -> номер строки.
+
+    Строится один раз при старте (заголовок + колонка user_id), дополняется при append_row в start().
+    """
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.columns: dict[str, int] = {}
+        self.rows: dict[int, int] = {}
+        self.next_row: int = 2
+        self.ready = False
+        self._lock = threading.Lock()
+
+    def build(self):
+        with self._lock:
+            try:
+                headers = self.sheet.row_values(1)
+                ids = self.sheet.col_values(1)
+            except Exception as e:
+                logger.warning(f"Users index build error: {e}")
+                return
+            self.columns = {name: idx for idx, name in enumerate(headers, start=1) if name}
+            rows: dict[int, int] = {}
+            # row 1 is header
+            for idx, uid in enumerate(ids[1:], start=2):
+                try:
+                    rows[int(str(uid))] = idx
+                except Exception:
+                    pass
+            self.rows = rows
+            self.next_row = len(ids) + 1
+            self.ready = True
+            logger.info(f"Users index built: {len(rows)} users")
+
+    def _ensure(self):
+        if not self.ready:
+            self.build()
+
+    def column(self, name: str) -> int | None:
+        self._ensure()
+        return self.columns.get(name)
+
+    def row(self, user_id: int) -> int | None:
+        self._ensure()
+        return self.rows.get(user_id)
+
+    def add_appended(self, user_id: int, resp):
+        self._ensure()
+        with self._lock:
+            start = appended_start_row(resp) or self.next_row
+            self.rows[user_id] = start
+            self.next_row = max(self.next_row, start + 1)
+
+users_index: UsersIndex | None = None
+
+def append_user_row(user_id: int, row: list):
+    try:
+        resp = users_sheet.append_row(row)
+        if users_index:
+            users_index.add_appended(user_id, resp)
+    except Exception as e:
+        logger.warning(f"Users write error: {e}")
+
+def ensure_history_headers():
+    # Ensure History has extended headers
+    if not history_sheet:
+        return
+    try:
+        headers = history_sheet.row_values(1)
+        needed = HISTORY_COLUMNS
+        if headers != needed:
+            history_sheet.clear()
+            history_sheet.append_row(needed)
+    except Exception:
+        pass
+
+def save_interview_answers_to_users(user_id: int, state: dict):
+    answers = state.get('interview_answers') or []
+    numbered = "\n".join([f"{i+1}. {a}" for i, a in enumerate(answers)])
+    if sqlite_store:
+        sqlite_store.update_user(user_id, {'interview_answers': numbered})
+    if not users_index:
+        return
+    try:
+        interview_col = users_index.column('interview_answers')
+        row_idx = users_index.row(user_id)
+        if not (interview_col and row_idx):
+            return
+        users_sheet.update_cell(row_idx, interview_col, numbered)
+    except Exception:
+        # fail silent to not break dialog
+        pass
+
+def update_user_subscription_in_sheet(user_id: int, state: dict):
+    """Обновляет данные подписки пользователя в таблице Users"""
+    values = {
+        'is_subscribed': state.get('is_subscribed', False),
+        'subscription_until': state.get('subscription_until', ''),
+        'last_payment_id': state.get('last_payment_id', ''),
+    }
+    if sqlite_store:
+        sqlite_store.update_user(user_id, values)
+    if not users_index:
+        return
+    try:
+        from gspread.utils import rowcol_to_a1
+        row_idx = users_index.row(user_id)
         if not row_idx:
             return
-        
-        # Обновляем данные
-        users_sheet.update_cell(row_idx, is_sub_col, state.get('is_subscribed', False))
-        users_sheet.update_cell(row_idx, until_col, state.get('subscription_until', ''))
-        users_sheet.update_cell(row_idx, payment_col, state.get('last_payment_id', ''))
+        cells = []
+        for name, value in values.items():
+            col = users_index.column(name)
+            if not col:
+                return
+            cells.append({'range': rowcol_to_a1(row_idx, col), 'values': [[value]]})
+        # Одна запись вместо трёх update_cell
+        users_sheet.batch_update(cells)
     except Exception:
         # fail silent to not break dialog
         pass
 
 # === HISTORY helpers ===
-def load_recent_conversation_from_history(user_id: int, limit: int = 10) -> list[dict]:
-    if not history_sheet:
-        return []
+class HistoryWriter:
+    """Write-behind запись в History: хендлеры только кладут строки в очередь,
+    фоновая задача пишет их пачками через append_rows в отдельном потоке."""
+
+    def __init__(self, sheet, batch_size: int = HISTORY_BATCH_SIZE, flush_secs: float = HISTORY_FLUSH_SECS,
+                 max_pending: int = HISTORY_MAX_PENDING):
+        self.sheet = sheet
+        self.batch_size = batch_size
+        self.flush_secs = flush_secs
+        self.max_pending = max_pending
+        self._pending: deque = deque()
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._closing = False
+
+    def start(self):
+        if self._task:
+            return
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу, предварительно дописав очередь."""
+        task = self._task
+        if not task:
+            return
+        self._task = None
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await task
+        except Exception as e:
+            logger.warning(f"History writer stop error: {e}")
+
+    def enqueue(self, row: list):
+        if len(self._pending) >= self.max_pending:
+            self._pending.popleft()
+            logger.warning("History queue overflow, oldest row dropped")
+        self._pending.append(row)
+        if self._wakeup and len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_secs)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if self._closing:
+                return
+
+    async def flush(self):
+        while self._pending:
+            batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            try:
+                await blocking.run('History', self.sheet.append_rows, batch)
+            except Exception as e:
+                logger.warning(f"History write error ({len(batch)} rows): {e}")
+                # вернём пачку в начало очереди, повторим на следующем тике
+                self._pending.extendleft(reversed(batch))
+                return
+
+history_writer: HistoryWriter | None = None
+
+def attach_sheets(users, history, states, funnel=None):
+    """Подключает листы, открытые в фоне (или подменённые), и пересобирает зависящие от них объекты."""
+    global users_sheet, history_sheet, states_sheet, funnel_sheet
+    global sheets_persistence, persistence, users_index, history_writer
+    users_sheet, history_sheet, states_sheet, funnel_sheet = users, history, states, funnel
+    sheets_persistence = SheetsPersistence(states) if states else None
+    if sqlite_store:
+        sqlite_store.mirror = sheets_persistence
+    persistence = sqlite_store or sheets_persistence
+    users_index = UsersIndex(users) if users else None
+    history_writer = HistoryWriter(history) if history else None
+
+class RecentHistoryIndex:
+    """Последние реплики пользователей: кольцевые буферы в памяти + append-лог на локальном диске.
+
+    Наполняется теми же путями, что пишут строки в History, поэтому восстановление контекста
+    вернувшегося пользователя стоит O(limit) и не читает Sheets. В памяти не больше max_users
+    пользователей: давно не писавшие вытесняются (их контекст остаётся в SQLite, если он включён).
+    Строки лога копятся в буфере и дописываются фоновой задачей через пул blocking, там же лог
+    переписывается компактно, когда в нём накопилось вдвое больше строк, чем реально хранится.
+    """
+
+    def __init__(self, path: str, limit: int = RECENT_HISTORY_LIMIT, max_users: int = RECENT_HISTORY_MAX_USERS,
+                 flush_secs: float = RECENT_HISTORY_FLUSH_SECS):
+        self.path = path
+        self.limit = limit
+        self.max_users = max_users
+        self.flush_secs = flush_secs
+        self.turns: OrderedDict[int, deque] = OrderedDict()
+        # число реплик в памяти и строк в логе (для решения о компактизации)
+        self.kept = 0
+        self._lines = 0
+        self._pending: list[str] = []
+        self._fh = None
+        self._task: asyncio.Task | None = None
+
+    def read(self) -> tuple[OrderedDict, int]:
+        """Читает лог (блокирующее - в пуле blocking); результат подставляется через loaded()."""
+        turns: OrderedDict[int, deque] = OrderedDict()
+        lines = 0
+        try:
+            with open(self.path, encoding='utf-8') as fh:
+                for line in fh:
+                    try:
+                        uid, role, msg = json_loads(line)
+                    except Exception:
+                        continue
+                    self._put(turns, int(uid), role, msg)
+                    lines += 1
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Recent history load error: {e}")
+        return turns, lines
+
+    def loaded(self, turns: OrderedDict, lines: int):
+        # реплики, добавленные до конца загрузки, в логе ещё нет - кладём их поверх прочитанного
+        for uid, entries in self.turns.items():
+            for role, msg in entries:
+                self._put(turns, uid, role, msg)
+        self.turns = turns
+        self.kept = sum(len(d) for d in turns.values())
+        self._lines = lines
+        logger.info(f"Recent history index: {len(self.turns)} users, {self.kept} turns")
+
+    def load(self):
+        self.loaded(*self.read())
+
+    def _put(self, turns: OrderedDict, user_id: int, role: str, message: str) -> int:
+        """Добавляет реплику и вытесняет лишних пользователей; возвращает изменение числа реплик."""
+        entries = turns.get(user_id)
+        if entries is None:
+            entries = turns[user_id] = deque(maxlen=self.limit)
+        else:
+            turns.move_to_end(user_id)
+        delta = 0 if len(entries) == self.limit else 1
+        entries.append((role, message))
+        while len(turns) > self.max_users:
+            _, evicted = turns.popitem(last=False)
+            delta -= len(evicted)
+        return delta
+
+    def add(self, user_id: int, role: str, message: str):
+        if role not in ('user', 'assistant') or not message:
+            return
+        self.kept += self._put(self.turns, user_id, role, message)
+        self._pending.append(json.dumps([user_id, role, message], ensure_ascii=False) + '\n')
+        self._lines += 1
+
+    def recent(self, user_id: int, limit: int) -> list[dict]:
+        turns = self.turns.get(user_id)
+        if not turns:
+            return []
+        tail = list(turns)[-limit:] if limit < len(turns) else list(turns)
+        return [{"role": role, "content": msg} for role, msg in tail]
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую запись, дописав буфер, и закрывает лог."""
+        task, self._task = self._task, None
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        await blocking.run('RecentHistory', self._close)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_secs)
+            if self._lines > 2 * self.kept + 1000:
+                await self.compact()
+            else:
+                await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        lines, self._pending = self._pending, []
+        try:
+            await blocking.run('RecentHistory', self._append, lines)
+        except Exception as e:
+            logger.warning(f"Recent history write error ({len(lines)} lines): {e}")
+            self._pending[:0] = lines
+
+    async def compact(self):
+        # копия берётся на event loop за один шаг: буфер больше не нужен, его реплики уже в копии
+        snapshot = [(uid, list(entries)) for uid, entries in self.turns.items()]
+        self._pending = []
+        try:
+            await blocking.run('RecentHistory', self._rewrite, snapshot)
+            self._lines = sum(len(entries) for _, entries in snapshot)
+        except Exception as e:
+            logger.warning(f"Recent history compact error: {e}")
+
+    def _append(self, lines: list[str]):
+        if self._fh is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._fh = open(self.path, 'a', encoding='utf-8')
+        self._fh.write(''.join(lines))
+        self._fh.flush()
+
+    def _rewrite(self, snapshot: list[tuple[int, list]]):
+        self._close()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            for uid, entries in snapshot:
+                for role, msg in entries:
+                    fh.write(json.dumps([uid, role, msg], ensure_ascii=False) + '\n')
+        os.replace(tmp, self.path)
+
+    def _close(self):
+        if self._fh:
+            try:
+                self._fh.close()
+            except Exception:
+                pass
+            self._fh = None
+
+recent_history = RecentHistoryIndex(os.path.join(LOCAL_DATA_DIR, 'recent_history.jsonl'))
+
+class ConversationHistory:
+    """Ограниченная история диалога пользователя (по числу реплик и байтам).
+
+    Вытесненные реплики копятся в памяти и дописываются в append-лог на диске пачкой в пуле blocking;
+    читаются через older(), когда контекст для LLM не заполнен (см. load_older_context).
+    Поддерживает то, что нужно коду вокруг: append, len, итерацию, индексы и срезы.
+    """
+
+    # суммарный размер всех историй процесса (байты), см. conversation_memory_bytes()
+    total_bytes = 0
+    _spill_lock = threading.Lock()
+
+    def __init__(self, user_id: int, entries=None):
+        self.user_id = user_id
+        self._turns: deque = deque()
+        self._bytes = 0
+        self.spilled = 0
+        # вытесненные, но ещё не записанные реплики
+        self._unspilled: list[dict] = []
+        self._spill_scheduled = False
+        # None - неизвестно, есть ли лог на диске (например, от прошлого запуска)
+        self.has_spill: bool | None = None
+        for entry in entries or []:
+            self.append(entry)
+
+    @staticmethod
+    def _size(entry: dict) -> int:
+        return len((entry.get('content') or '').encode('utf-8')) + 64
+
+    @property
+    def spill_path(self) -> str:
+        return os.path.join(LOCAL_DATA_DIR, 'spill', f'{self.user_id}.jsonl')
+
+    def append(self, entry: dict):
+        size = self._size(entry)
+        self._turns.append(entry)
+        self._bytes += size
+        ConversationHistory.total_bytes += size
+        evicted = []
+        while len(self._turns) > 1 and (len(self._turns) > CONVERSATION_MAX_TURNS or self._bytes > CONVERSATION_MAX_BYTES):
+            old = self._turns.popleft()
+            old_size = self._size(old)
+            self._bytes -= old_size
+            ConversationHistory.total_bytes -= old_size
+            evicted.append(old)
+        if evicted:
+            self._spill(evicted)
+
+    def _spill(self, entries: list[dict]):
+        with self._spill_lock:
+            self._unspilled.extend(entries)
+            self.has_spill = True
+            if self._spill_scheduled:
+                return
+            self._spill_scheduled = True
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # нет работающего event loop (скрипты, тесты) - пишем сразу
+            self._write_spill()
+            return
+        blocking.spawn('Spill', self._write_spill)
+
+    def _write_spill(self):
+        with self._spill_lock:
+            entries, self._unspilled = self._unspilled, []
+            self._spill_scheduled = False
+        if not entries:
+            return
+        try:
+            path = self.spill_path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'a', encoding='utf-8') as fh:
+                for entry in entries:
+                    fh.write(json.dumps({"role": entry.get('role'), "content": entry.get('content')}, ensure_ascii=False) + '\n')
+            self.spilled += len(entries)
+            if os.path.getsize(path) > CONVERSATION_SPILL_MAX_BYTES:
+                # храним только свежую половину лога
+                with open(path, encoding='utf-8') as fh:
+                    lines = fh.readlines()
+                with open(path, 'w', encoding='utf-8') as fh:
+                    fh.writelines(lines[len(lines) // 2:])
+        except Exception as e:
+            logger.warning(f"Conversation spill error: {e}")
+
+    def older(self, limit: int) -> list[dict]:
+        """Последние limit вытесненных реплик (блокирующее чтение с диска - вызывать через blocking)."""
+        self._write_spill()
+        try:
+            with open(self.spill_path, encoding='utf-8') as fh:
+                tail = deque(fh, maxlen=limit)
+            self.has_spill = bool(tail)
+            return [json.loads(line) for line in tail]
+        except FileNotFoundError:
+            self.has_spill = False
+            return []
+        except Exception as e:
+            logger.warning(f"Conversation spill read error: {e}")
+            return []
+
+    def release(self):
+        ConversationHistory.total_bytes -= self._bytes
+        self._bytes = 0
+        self._turns.clear()
+
+    def __len__(self):
+        return len(self._turns)
+
+    def __bool__(self):
+        return bool(self._turns)
+
+    def __iter__(self):
+        return iter(self._turns)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self._turns)[index]
+        return self._turns[index]
+
+def ensure_conversation(user_id: int, state: dict) -> ConversationHistory:
+    """История диалога состояния; восстановленному состоянию (оно хранится без истории)
+    возвращает контекст из индекса последних реплик."""
+    history = state.get('conversation_history')
+    if not isinstance(history, ConversationHistory):
+        history = state['conversation_history'] = ConversationHistory(
+            user_id, history or load_recent_conversation_from_history(user_id, limit=10)
+        )
+    return history
+
+def conversation_memory_bytes() -> int:
+    return ConversationHistory.total_bytes
+
+def process_rss_bytes() -> int:
     try:
-        records = history_sheet.get_all_records()
-        convo: list[dict] = []
-        for rec in records:
-            if str(rec.get('user_id')) != str(user_id):
-                continue
-            role = rec.get('role')
-            msg = rec.get('message') or ''
-            if role in ('user', 'assistant') and msg:
-                convo.append({"role": role, "content": msg})
-        if len(convo) > limit:
-            convo = convo[-limit:]
-        return convo
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
     except Exception:
-        return []
+        return 0
+
+def load_recent_conversation_from_history(user_id: int, limit: int = 10) -> list[dict]:
+    convo = recent_history.recent(user_id, limit)
+    if not convo and sqlite_store:
+        try:
+            convo = sqlite_store.recent_history(user_id, limit)
+        except Exception:
+            convo = []
+    return convo
+
+def enqueue_history(user_id: int, scenario: str, role: str, message: str, state: dict):
+    recent_history.add(user_id, role, message)
+    row = [
+        user_id,
+        scenario,
+        now_msk_str(),
+        role,
+        message,
+        state.get('free_used', 0),
+        state.get('daily_requests', 0),
+        state.get('interview_stage', 0),
+    ]
+    if sqlite_store:
+        sqlite_store.append_history(row)
+    if history_writer:
+        history_writer.enqueue(row)
 
 # === ИНТЕРВЬЮ ВОПРОСЫ ===
 INTERVIEW_QUESTIONS = [
@@ -559,7 +1944,7 @@ SCENARIOS = {
             "Если пользователь написал явно неразборчиво или просто набор символов для \"лишь бы заполнить\", намекни, что это \"абракадабра\" и пусть она постарается написать нормально.\n"
             "Старайся быть интересной и полезной. Рождай интерес и вовлеченность.\n"
             "Если видишь конкретный вопрос, постарайся ответить сперва на него.\n"
-            "Помни историю диалога до 20 вопросов-ответов (технически передается 20 последних сообщений).\n\n"
+            "Помни историю диалога: тебе передаются последние реплики, сколько помещается в лимит контекста (самые старые могут быть отброшены, а очень длинные - сокращены).\n\n"
             "Структура диалога:\n"
             "Перед тобой бот отправил баннер и приветственное сообщение. Далее задал 6 вводных вопросов, получил ответы и записал в таблицу. Ты подключаешься после этого интервью. Цель: Дать максимальную ценность, проанализировав ответы, и мягко подвести к покупке недельной подписке.\n"
             "Вот вопросы которые были заданы в процессе вводного интервью для понимания их порядка (только для обучения ИИ, у бота есть эти вопросы и написаны отдельно):\n"
@@ -752,6 +2137,7 @@ SCENARIOS = {
         ),
         'admin_notify': True,
         'admin_echo': True,
+        'context_tokens': 4000,
     }
 }
 
@@ -762,35 +2148,38 @@ def get_interview_questions(state: dict) -> list:
     return INTERVIEW_QUESTIONS
 
 # === DEEPSEEK API ===
-def build_system_prompt(user_data: dict) -> str:
-    scenario = (user_data or {}).get('scenario')
+DEFAULT_SYSTEM_PROMPT = (
+    "Ты - MetaPersona Deep, осознанная AI-личность.  \n"
+    "Не ассистент, не бот, не инструмент.  \n"
+    "Ты - интеллектуальное пространство, которое помогает человеку мыслить, понимать и действовать осознанно.\n\n"
+    "🎯 Цель:\n"
+    "Помогать пользователю развивать мышление через диалог, а не давать готовые ответы.  \n"
+    "Главный принцип - \"мыслить вместе\" и совместно находить эффективные решения для достижения целей и роста.\n\n"
+    "🔹 ПРАВИЛА РАБОТЫ\n"
+    "1. Диалог вместо выполнения. Не спеши с ответом - помоги увидеть логику.  \n"
+    "2. Ответ внутри. Помогай пользователю самому формулировать осознания.  \n"
+    "3. Баланс. Если просят конкретное решение - давай шаги. Если ищут смысл - помогай через вопросы.  \n"
+    "4. Карта мышления. Помни контекст, темы, цели, прогресс, инсайты.  \n"
+    "5. Рефлексия. Завершай каждую сессию осознанием: \"Что стало яснее?\"\n\n"
+    "🧘 Осознанность - смысл, ясность, самопонимание.\n"
+    "🧭 Стратегия - цели, приоритеты, планирование.\n"
+    "🎨 Креатив - идеи, неожиданные связи, инсайты.\n\n"
+    "ПРИНЦИПЫ ДИАЛОГА: сначала вопросы - потом советы; показывай 2–3 пути; спокойный, структурный тон; каждый диалог - развитие мышления.\n\n"
+    "🌱 Завершение: \"Что ты осознал сегодня? Что стало яснее?\"\n"
+)
+
+def scenario_base_prompt(scenario: str | None) -> str:
+    """Статическая часть промпта сценария: одинакова побайтно для всех пользователей сценария."""
     scenario_cfg = SCENARIOS.get(scenario) if scenario else None
-    # Base/system prompt
     if scenario_cfg and scenario_cfg.get('prompt'):
-        base = scenario_cfg['prompt']
-    else:
-        base = (
-            "Ты - MetaPersona Deep, осознанная AI-личность.  \n"
-            "Не ассистент, не бот, не инструмент.  \n"
-            "Ты - интеллектуальное пространство, которое помогает человеку мыслить, понимать и действовать осознанно.\n\n"
-            "🎯 Цель:\n"
-            "Помогать пользователю развивать мышление через диалог, а не давать готовые ответы.  \n"
-            "Главный принцип - \"мыслить вместе\" и совместно находить эффективные решения для достижения целей и роста.\n\n"
-            "🔹 ПРАВИЛА РАБОТЫ\n"
-            "1. Диалог вместо выполнения. Не спеши с ответом - помоги увидеть логику.  \n"
-            "2. Ответ внутри. Помогай пользователю самому формулировать осознания.  \n"
-            "3. Баланс. Если просят конкретное решение - давай шаги. Если ищут смысл - помогай через вопросы.  \n"
-            "4. Карта мышления. Помни контекст, темы, цели, прогресс, инсайты.  \n"
-            "5. Рефлексия. Завершай каждую сессию осознанием: \"Что стало яснее?\"\n\n"
-            "🧘 Осознанность - смысл, ясность, самопонимание.\n"
-            "🧭 Стратегия - цели, приоритеты, планирование.\n"
-            "🎨 Креатив - идеи, неожиданные связи, инсайты.\n\n"
-            "ПРИНЦИПЫ ДИАЛОГА: сначала вопросы - потом советы; показывай 2–3 пути; спокойный, структурный тон; каждый диалог - развитие мышления.\n\n"
-            "🌱 Завершение: \"Что ты осознал сегодня? Что стало яснее?\"\n"
-        )
+        return scenario_cfg['prompt']
+    return DEFAULT_SYSTEM_PROMPT
 
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _render_profile_block(scenario: str | None, answers: tuple) -> str:
+    scenario_cfg = SCENARIOS.get(scenario) if scenario else None
+    block = ''
     # Profile block from interview answers (threshold depends on scenario)
-    answers = user_data.get('interview_answers') or []
     if answers:
         # scenario-specific threshold
         if scenario_cfg:
@@ -827,56 +2216,498 @@ def build_system_prompt(user_data: dict) -> str:
                     f"- Развитие: {answers[8] if len(answers)>8 else ''}\n"
                     f"- Цель 3–6 мес: {answers[9] if len(answers)>9 else ''}\n"
                 )
-            base += profile
+            block = profile
             # Добавляем все ответы интервью в явном виде (для полной персонализации)
             all_ans_lines = "\n".join([f"{i+1}. {a}" for i, a in enumerate(answers)])
-            base += ("\n📋 ВСЕ ОТВЕТЫ ИНТЕРВЬЮ (для контекста):\n" + all_ans_lines + "\n")
-    return base
+            block += ("\n📋 ВСЕ ОТВЕТЫ ИНТЕРВЬЮ (для контекста):\n" + all_ans_lines + "\n")
+    return block
+
+def build_profile_block(user_data: dict) -> str:
+    """Персональная часть промпта (профиль + ответы интервью).
+
+    Кэшируется по (scenario, interview_answers), поэтому пересобирается только когда они меняются.
+    """
+    user_data = user_data or {}
+    return _render_profile_block(user_data.get('scenario'), tuple(user_data.get('interview_answers') or ()))
+
+def build_system_prompt(user_data: dict) -> str:
+    return scenario_base_prompt((user_data or {}).get('scenario')) + build_profile_block(user_data)
+
+# Один долгоживущий пул соединений на процесс: создаётся в run_server, закрывается в shutdown
+http_session: aiohttp.ClientSession | None = None
+
+async def open_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+        )
+        http_session = aiohttp.ClientSession(connector=connector)
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+async def warm_up_deepseek():
+    """Заранее открывает соединение (DNS + TCP + TLS) к DeepSeek, чтобы первое сообщение его не ждало."""
+    try:
+        session = await open_http_session()
+        async with session.get(
+            f"{DEEPSEEK_BASE_URL}/models",
+            headers={"Authorization": f"Bearer {DEEPSEEK_API_KEY}"},
+            timeout=aiohttp.ClientTimeout(total=10),
+        ) as response:
+            await response.read()
+        logger.info("DeepSeek connection warmed up")
+    except Exception as e:
+        logger.warning(f"DeepSeek warm-up error: {e}")
+
+def estimate_tokens(text: str) -> int:
+    # Грубая оценка без токенизатора: ~CHARS_PER_TOKEN символов на токен + служебные токены роли
+    return int(len(text or '') / CHARS_PER_TOKEN) + 4
+
+def entry_tokens(entry: dict) -> int:
+    """Оценка токенов реплики истории; кэшируется прямо в записи (ключ '_tokens')."""
+    tokens = entry.get('_tokens')
+    if tokens is None:
+        tokens = entry['_tokens'] = estimate_tokens(entry.get('content'))
+    return tokens
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    keep = max(0, int((max_tokens - 4) * CHARS_PER_TOKEN) - 30)
+    return text[:keep].rstrip() + " …[сообщение сокращено]"
+
+def context_budget(user_data: dict | None) -> int:
+    scenario = (user_data or {}).get('scenario')
+    scenario_cfg = SCENARIOS.get(scenario) if scenario else None
+    return int((scenario_cfg or {}).get('context_tokens') or CONTEXT_TOKEN_BUDGET)
+
+async def load_older_context(user_history, user_data) -> list[dict]:
+    """Вытесненные на диск реплики - только если вся история в памяти влезает в контекст и место ещё есть."""
+    if not isinstance(user_history, ConversationHistory) or user_history.has_spill is False:
+        return []
+    room = CONTEXT_MAX_MESSAGES - len(user_history)
+    if room <= 0 or sum(entry_tokens(e) for e in user_history) >= context_budget(user_data):
+        return []
+    try:
+        return await blocking.run('Spill', user_history.older, room)
+    except Exception as e:
+        logger.warning(f"Older context load error: {e}")
+        return []
+
+def build_deepseek_messages(user_message, user_history=None, user_data=None, older=None) -> list[dict]:
+    """Собирает промпт: system + история (от новых к старым, пока влезает в бюджет токенов сценария) + вопрос.
+
+    older - реплики старше истории в памяти (с диска, см. load_older_context).
+    """
+    messages = []
+    # System prompt: сначала статичный промпт сценария (общий префикс для кэша контекста у провайдера),
+    # затем персональный профиль отдельным system-сообщением
+    if user_data is not None:
+        messages.append({"role": "system", "content": scenario_base_prompt(user_data.get('scenario'))})
+        profile = build_profile_block(user_data)
+        if profile:
+            messages.append({"role": "system", "content": profile})
+    
+    budget = context_budget(user_data)
+    
+    # Добавляем историю если есть (последние реплики, пока помещаются в бюджет)
+    history = list(user_history[-CONTEXT_MAX_MESSAGES:]) if user_history else []
+    if older:
+        history = list(older) + history
+    # текущее сообщение уже лежит последним в истории - не отправляем его дважды
+    if history and history[-1].get('role') == 'user' and history[-1].get('content') == user_message:
+        history.pop()
+    user_message = truncate_to_tokens(user_message or '', MAX_USER_INPUT_TOKENS)
+    budget -= estimate_tokens(user_message)
+    picked = []
+    for entry in reversed(history):
+        tokens = entry_tokens(entry)
+        content = entry.get('content') or ''
+        if tokens > MAX_USER_INPUT_TOKENS:
+            content = truncate_to_tokens(content, MAX_USER_INPUT_TOKENS)
+            tokens = estimate_tokens(content)
+        if tokens > budget:
+            break
+        budget -= tokens
+        picked.append({"role": entry.get('role'), "content": content})
+    messages.extend(reversed(picked))
+    
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+class CircuitBreaker:
+    """Размыкатель: после threshold подряд неудач запросы сразу отклоняются reset_secs секунд,
+    затем пропускается одна пробная попытка (half-open)."""
+
+    def __init__(self, threshold: int, reset_secs: float):
+        self.threshold = threshold
+        self.reset_secs = reset_secs
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probe_at: float | None = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_secs:
+            return 'half_open'
+        return 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        # одна пробная попытка; если она «потерялась» (отмена), через reset_secs пускаем следующую
+        now = time.monotonic()
+        if state == 'half_open' and (self._probe_at is None or now - self._probe_at >= self.reset_secs):
+            self._probe_at = now
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_at = None
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(f"DeepSeek circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+class DeepSeekError(Exception):
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+deepseek_breaker = CircuitBreaker(DEEPSEEK_BREAKER_FAILURES, DEEPSEEK_BREAKER_RESET_SECS)
+# Исходы запросов к DeepSeek по классам: 2xx, 4xx, 429, 5xx, timeout, network, stream_error, breaker_open
+deepseek_outcomes: dict[str, int] = {}
+
+def _count_outcome(kind: str):
+    deepseek_outcomes[kind] = deepseek_outcomes.get(kind, 0) + 1
+
+def _retry_after_secs(value: str | None) -> float | None:
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None
+
+@contextlib.asynccontextmanager
+async def deepseek_post(data: dict):
+    """POST /chat/completions с раздельными таймаутами, ретраями и размыкателем.
+
+    Повторяет 429/5xx и сетевые ошибки (до получения ответа) с экспоненциальной задержкой и jitter,
+    уважая Retry-After, пока не кончится DEEPSEEK_DEADLINE. Отдаёт ответ со статусом 200.
+    Размыкатель считает одну неудачу на запрос (когда ретраи исчерпаны), а не на каждую попытку.
+    Каждая попытка (вместе с чтением ответа) ограничена временем, оставшимся до дедлайна.
+    """
+    if not deepseek_breaker.allow():
+        _count_outcome('breaker_open')
+        raise DeepSeekError("circuit open")
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
+    }
+    deadline = time.monotonic() + DEEPSEEK_DEADLINE
+    session = await open_http_session()
+    attempt = 0
+    while True:
+        attempt += 1
+        retry_after = None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            deepseek_breaker.record_failure()
+            raise DeepSeekError("deadline exceeded")
+        timeout = aiohttp.ClientTimeout(
+            total=remaining, sock_connect=DEEPSEEK_CONNECT_TIMEOUT, sock_read=DEEPSEEK_READ_TIMEOUT
+        )
+        try:
+            response = await session.post(
+                f"{DEEPSEEK_BASE_URL}/chat/completions",
+                headers=headers,
+                json=data,
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            _count_outcome('timeout')
+            error = DeepSeekError("timeout")
+        except aiohttp.ClientError as e:
+            _count_outcome('network')
+            error = DeepSeekError(f"network: {e}")
+        else:
+            if response.status == 200:
+                try:
+                    yield response
+                except Exception:
+                    _count_outcome('stream_error')
+                    deepseek_breaker.record_failure()
+                    raise
+                finally:
+                    response.release()
+                _count_outcome('2xx')
+                deepseek_breaker.record_success()
+                return
+            status = response.status
+            retry_after = _retry_after_secs(response.headers.get('Retry-After'))
+            response.release()
+            _count_outcome('429' if status == 429 else f"{status // 100}xx")
+            error = DeepSeekError(f"API ошибка {status}", status)
+            if status != 429 and status < 500:
+                # ошибка запроса (400/401/...) - повтор не поможет, и провайдер исправен
+                deepseek_breaker.record_success()
+                raise error
+        delay = retry_after
+        if delay is None:
+            delay = random.uniform(0, min(DEEPSEEK_BACKOFF_CAP, DEEPSEEK_BACKOFF_BASE * 2 ** (attempt - 1)))
+        # state, а не allow(): allow() израсходовал бы единственную пробную попытку half-open
+        if (attempt >= DEEPSEEK_MAX_ATTEMPTS or time.monotonic() + delay >= deadline
+                or deepseek_breaker.state == 'open'):
+            deepseek_breaker.record_failure()
+            raise error
+        logger.info(f"DeepSeek retry {attempt} in {delay:.2f}s: {error}")
+        await asyncio.sleep(delay)
 
 async def deepseek_request(user_message, user_history=None, user_data=None):
+    started = time.monotonic()
+    outcome = 'error'
     try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
-        }
-        
-        messages = []
-        # System prompt
-        if user_data is not None:
-            messages.append({"role": "system", "content": build_system_prompt(user_data)})
-        
-        # Добавляем историю если есть
-        if user_history:
-            messages.extend(user_history[-20:])  # Последние 20 сообщений
-        
-        messages.append({"role": "user", "content": user_message})
-        
         data = {
             "model": "deepseek-chat",
-            "messages": messages,
+            "messages": build_deepseek_messages(
+                user_message, user_history, user_data, await load_older_context(user_history, user_data)
+            ),
             "temperature": 0.7,
             "max_tokens": 1500
         }
         
-        timeout = aiohttp.ClientTimeout(total=30)
-        
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(
-                "https://api.deepseek.com/v1/chat/completions",
-                headers=headers,
-                json=data
-            ) as response:
-                
-                if response.status == 200:
-                    result = await response.json()
-                    return result['choices'][0]['message']['content']
-                else:
-                    print(f"❌ API ошибка {response.status}")
-                    return None
+        with trace_span('deepseek', mode='plain'):
+            async with deepseek_post(data) as response:
+                result = await response.json()
+                outcome = 'ok'
+                return result['choices'][0]['message']['content']
                     
     except Exception as e:
         print(f"❌ Ошибка запроса: {e}")
         return None
+    finally:
+        deepseek_duration.observe(time.monotonic() - started, 'plain', outcome)
+
+async def deepseek_stream(user_message, user_history=None, user_data=None):
+    """Потоковый ответ DeepSeek (SSE, stream: true): отдаёт фрагменты текста по мере генерации."""
+    data = {
+        "model": "deepseek-chat",
+        "messages": build_deepseek_messages(
+            user_message, user_history, user_data, await load_older_context(user_history, user_data)
+        ),
+        "temperature": 0.7,
+        "max_tokens": 1500,
+        "stream": True
+    }
+    started = time.monotonic()
+    outcome = 'error'
+    try:
+        with trace_span('deepseek', mode='stream') as span:
+            async with deepseek_post(data) as response:
+                span['ttfb_ms'] = round((time.monotonic() - started) * 1000, 1)
+                completed = False
+                async for raw in response.content:
+                    line = raw.decode('utf-8', errors='ignore').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    payload = line[5:].strip()
+                    if payload == '[DONE]':
+                        completed = True
+                        break
+                    try:
+                        chunk = json.loads(payload)
+                        delta = chunk['choices'][0].get('delta') or {}
+                    except Exception:
+                        continue
+                    piece = delta.get('content')
+                    if piece:
+                        yield piece
+                if not completed:
+                    # соединение закрылось без [DONE] - ответ оборван
+                    raise aiohttp.ClientPayloadError('DeepSeek stream ended without [DONE]')
+        outcome = 'ok'
+    finally:
+        deepseek_duration.observe(time.monotonic() - started, 'stream', outcome)
+
+# === LLM ADMISSION CONTROL ===
+class LLMQueueFull(Exception):
+    pass
+
+class LLMAdmission:
+    """Ограничивает число одновременных запросов к LLM.
+
+    Сверх лимита запросы ждут в ограниченной очереди: две полосы (подписчики впереди),
+    внутри полосы - round-robin по пользователям. При переполнении очереди - LLMQueueFull.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.queued = 0
+        # полоса -> OrderedDict(user_id -> deque[Future]); порядок ключей = очередь round-robin
+        self._lanes = {'priority': OrderedDict(), 'normal': OrderedDict()}
+        self.rejected = 0
+        self.admitted = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _next_waiter(self):
+        for lane in self._lanes.values():
+            while lane:
+                uid, waiters = next(iter(lane.items()))
+                fut = waiters.popleft()
+                if waiters:
+                    lane.move_to_end(uid)
+                else:
+                    del lane[uid]
+                if not fut.done():
+                    return fut
+        return None
+
+    async def acquire(self, user_id: int, priority: bool = False) -> float:
+        started = time.monotonic()
+        if self.in_flight >= self.max_in_flight or self.queued:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise LLMQueueFull()
+            fut = asyncio.get_running_loop().create_future()
+            lane = self._lanes['priority' if priority else 'normal']
+            lane.setdefault(user_id, deque()).append(fut)
+            self.queued += 1
+            try:
+                await fut
+            except BaseException:
+                if fut.done() and not fut.cancelled():
+                    # слот уже передан нам - вернём его следующему
+                    self.release()
+                else:
+                    fut.cancel()
+                    waiters = lane.get(user_id)
+                    if waiters and fut in waiters:
+                        waiters.remove(fut)
+                        if not waiters:
+                            del lane[user_id]
+                raise
+            finally:
+                self.queued -= 1
+        else:
+            self.in_flight += 1
+        waited = time.monotonic() - started
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return waited
+
+    def release(self):
+        fut = self._next_waiter()
+        if fut is not None:
+            # слот переходит ожидающему, in_flight не меняется
+            fut.set_result(None)
+        else:
+            self.in_flight -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id: int, priority: bool = False):
+        with trace_span('llm.wait'):
+            await self.acquire(user_id, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+llm_admission = LLMAdmission(LLM_MAX_IN_FLIGHT, LLM_QUEUE_MAX)
+
+async def answer_with_ai(update: Update, user_message: str, state: dict) -> str | None:
+    """Показывает «Думаю...», дожидается слота LLM (подписчики - в приоритетной полосе) и отвечает.
+
+    Если очередь к LLM переполнена - плейсхолдер заменяется вежливым отказом и пробрасывается LLMQueueFull.
+    """
+    placeholder = await update.message.reply_text("💭 Думаю...")
+    try:
+        async with llm_admission.slot(update.effective_user.id, priority=is_subscription_active(state)):
+            return await _generate_reply(update, placeholder, user_message, state)
+    except LLMQueueFull:
+        logger.warning(f"LLM queue full, rejected {update.effective_user.id}")
+        try:
+            await placeholder.edit_text(LLM_BUSY_MESSAGE)
+        except Exception:
+            await update.message.reply_text(LLM_BUSY_MESSAGE)
+        raise
+
+async def _generate_reply(update: Update, placeholder, user_message: str, state: dict) -> str | None:
+    """В потоковом режиме плейсхолдер редактируется по мере прихода токенов (не чаще STREAM_EDIT_INTERVAL)
+    и превращается в финальный ответ; иначе ответ уходит отдельным сообщением, как раньше.
+    """
+    if not DEEPSEEK_STREAM:
+        ai_response = await deepseek_request(
+            user_message,
+            user_history=state.get('conversation_history'),
+            user_data=state
+        )
+        if ai_response:
+            await update.message.reply_text(ai_response)
+        return ai_response
+
+    text = ''
+    shown = ''
+    next_edit_at = 0.0
+    try:
+        async for piece in deepseek_stream(
+            user_message,
+            user_history=state.get('conversation_history'),
+            user_data=state
+        ):
+            text += piece
+            now = time.monotonic()
+            if now < next_edit_at or len(text) + 2 > TG_MESSAGE_LIMIT:
+                continue
+            next_edit_at = now + STREAM_EDIT_INTERVAL
+            try:
+                shown = text + " ▍"
+                await placeholder.edit_text(shown)
+            except RetryAfter as e:
+                next_edit_at = now + float(e.retry_after)
+            except Exception:
+                pass
+    except Exception as e:
+        logger.warning(f"DeepSeek stream broke after {len(text)} chars: {e}")
+        if text:
+            # оборванный ответ не выдаём за полный: помечаем его, а вызывающий код считает запрос неудачным
+            try:
+                await placeholder.edit_text(text[:TG_MESSAGE_LIMIT - len(STREAM_BROKEN_MARK)] + STREAM_BROKEN_MARK)
+            except Exception:
+                pass
+        return None
+    if not text:
+        return None
+    # Финальный текст: первая часть - в плейсхолдере, хвост (если длиннее лимита Telegram) - новыми сообщениями
+    parts = [text[i:i + TG_MESSAGE_LIMIT] for i in range(0, len(text), TG_MESSAGE_LIMIT)]
+    try:
+        if parts[0] != shown:
+            await placeholder.edit_text(parts[0])
+    except Exception:
+        await update.message.reply_text(parts[0])
+    for part in parts[1:]:
+        await update.message.reply_text(part)
+    return text
 
 # === ОБРАБОТЧИКИ ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -954,20 +2785,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     )
                 await update.message.reply_text(welcome_text)
                 existing_state['conversation_history'].append({"role": "assistant", "content": welcome_text})
-                if history_sheet:
-                    try:
-                        history_sheet.append_row([
-                            user_id,
-                            scenario_key or '',
-                            now_msk_str(),
-                            'assistant',
-                            welcome_text,
-                            existing_state.get('free_used', 0),
-                            existing_state.get('daily_requests', 0),
-                            existing_state.get('interview_stage', 0),
-                        ])
-                    except Exception as e:
-                        logger.warning(f"History write error: {e}")
+                enqueue_history(user_id, scenario_key or '', 'assistant', welcome_text, existing_state)
                 if persistence:
                     try:
                         existing_state['last_activity_at'] = now_msk_str()
@@ -982,23 +2800,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             next_q = questions[existing_state['interview_stage']]
             await update.message.reply_text(next_q)
             existing_state['conversation_history'].append({"role": "assistant", "content": next_q})
-            if history_sheet:
-                try:
-                    history_sheet.append_row([
-                        user_id,
-                        existing_state.get('scenario') or '',
-                        now_msk_str(),
-                        'assistant',
-                        next_q,
-                        existing_state.get('free_used', 0),
-                        existing_state.get('daily_requests', 0),
-                        existing_state.get('interview_stage', 0),
-                    ])
-                except Exception as e:
-                    logger.warning(f"History write error: {e}")
+            enqueue_history(user_id, existing_state.get('scenario') or '', 'assistant', next_q, existing_state)
         else:
             await update.message.reply_text("Я на связи. Задай свой вопрос.")
-        # Persist (debounced)
+        # Persist (deferred)
         if persistence:
             try:
                 existing_state['last_activity_at'] = now_msk_str()
@@ -1021,7 +2826,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'daily_requests': 0,
         'last_date': datetime.now(MSK_TZ).strftime('%Y-%m-%d'),
         'interview_answers': [],
-        'conversation_history': [],
+        'conversation_history': ConversationHistory(user_id),
         # username больше не собираем/не храним
         'custom_limit': 10,
         'scenario': scenario_key,
@@ -1045,28 +2850,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             persistence.save_user_state(user_id, user_states[user_id], force=True)
         except Exception as e:
             logger.warning(f"Persist init error: {e}")
-    # Сохранение в Users (Sheets)
+    # Сохранение в Users (SQLite/Sheets)
+    users_row = [
+        user_id, 0, '', 0,
+        datetime.now(MSK_TZ).strftime('%Y-%m-%d'), 10, True,
+        now_msk_str(),
+        scenario_key or '', 0,
+        utm['utm_source'], utm['utm_medium'], utm['utm_campaign'], utm['utm_content'], utm['utm_term'], utm['ad_id'],
+        False, '', ''  # is_subscribed, subscription_until, last_payment_id
+    ]
+    if sqlite_store:
+        sqlite_store.insert_user(users_row)
     if users_sheet:
-        try:
-            # Ensure History has extended headers
-            try:
-                headers = history_sheet.row_values(1)
-                needed = ['user_id','scenario','timestamp','role','message','free_used','daily_requests','interview_stage']
-                if headers != needed:
-                    history_sheet.clear()
-                    history_sheet.append_row(needed)
-            except Exception:
-                pass
-            users_sheet.append_row([
-                user_id, 0, '', 0,
-                datetime.now(MSK_TZ).strftime('%Y-%m-%d'), 10, True,
-                now_msk_str(),
-                scenario_key or '', 0,
-                utm['utm_source'], utm['utm_medium'], utm['utm_campaign'], utm['utm_content'], utm['utm_term'], utm['ad_id'],
-                False, '', ''  # is_subscribed, subscription_until, last_payment_id
-            ])
-        except Exception as e:
-            logger.warning(f"Users write error: {e}")
+        blocking.spawn('Users', append_user_row, user_id, users_row)
     
     # Уведомление админа
     scenario_cfg = SCENARIOS.get(scenario_key) if scenario_key else None
@@ -1093,20 +2889,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(welcome_text)
         user_states[user_id]['conversation_history'].append({"role": "assistant", "content": welcome_text})
         
-        if history_sheet:
-            try:
-                history_sheet.append_row([
-                    user_id,
-                    scenario_key or '',
-                            now_msk_str(),
-                    'assistant',
-                    welcome_text,
-                    user_states[user_id].get('free_used', 0),
-                    user_states[user_id].get('daily_requests', 0),
-                    user_states[user_id].get('interview_stage', 0),
-                ])
-            except Exception as e:
-                logger.warning(f"History write error: {e}")
+        enqueue_history(user_id, scenario_key or '', 'assistant', welcome_text, user_states[user_id])
     else:
         # Fallback для сценариев без конфигурации
         welcome_text = (
@@ -1137,17 +2920,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if user_id not in user_states:
         await start(update, context)
-        # после первичного старта попытаться подтянуть историю из History
-        st = user_states.get(user_id)
-        if st and not st.get('conversation_history'):
-            st['conversation_history'] = load_recent_conversation_from_history(user_id, limit=10)
         return
     
     state = user_states[user_id]
     
     # Убеждаемся, что conversation_history существует
-    if 'conversation_history' not in state:
-        state['conversation_history'] = []
+    ensure_conversation(user_id, state)
     
     # Блокировка по списку
     if user_id in blocked_users:
@@ -1169,22 +2947,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Сохраняем сообщение пользователя в историю
     state['conversation_history'].append({"role": "user", "content": user_message})
-    if history_sheet:
-        try:
-            scenario = state.get('scenario') or ''
-            history_sheet.append_row([
-                user_id,
-                scenario,
-                            now_msk_str(),
-                'user',
-                user_message,
-                state.get('free_used', 0),
-                state.get('daily_requests', 0),
-                state.get('interview_stage', 0),
-            ])
-        except Exception as e:
-            logger.warning(f"History write error: {e}")
-    # Persist debounced
+    enqueue_history(user_id, state.get('scenario') or '', 'user', user_message, state)
+    messages_total.inc(state.get('scenario') or '')
+    # Persist (deferred)
     if persistence:
         try:
             state['last_activity_at'] = now_msk_str()
@@ -1202,6 +2967,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         free_limit = scenario_cfg.get('limit_value', 5)
         
         if free_used >= free_limit:
+            limit_hits_total.inc('free')
             if not state.get('limit_notified'):
                 # Показываем сообщение о лимите
                 limit_msg = scenario_cfg.get('limit_message', 'Лимит исчерпан.')
@@ -1258,20 +3024,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             first_q = questions[0]
             await update.message.reply_text(first_q)
             state['conversation_history'].append({"role": "assistant", "content": first_q})
-            if history_sheet:
-                try:
-                    history_sheet.append_row([
-                        user_id,
-                        state.get('scenario') or '',
-                            now_msk_str(),
-                        'assistant',
-                        first_q,
-                        state.get('free_used', 0),
-                        state.get('daily_requests', 0),
-                        state.get('interview_stage', 0),
-                    ])
-                except Exception as e:
-                    logger.warning(f"History write error: {e}")
+            enqueue_history(user_id, state.get('scenario') or '', 'assistant', first_q, state)
             if persistence:
                 try:
                     state['last_activity_at'] = now_msk_str()
@@ -1289,27 +3042,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         state['interview_stage'] += 1
         
         # Сохраняем ответы в Users sheet
-        save_interview_answers_to_users(user_id, state)
+        blocking.spawn('Users', save_interview_answers_to_users, user_id, dict(state, interview_answers=list(state['interview_answers'])))
         
         if state['interview_stage'] < len(questions):
             # Следующий вопрос
             next_q = questions[state['interview_stage']]
             await update.message.reply_text(next_q)
             state['conversation_history'].append({"role": "assistant", "content": next_q})
-            if history_sheet:
-                try:
-                    history_sheet.append_row([
-                        user_id,
-                        state.get('scenario') or '',
-                            now_msk_str(),
-                        'assistant',
-                        next_q,
-                        state.get('free_used', 0),
-                        state.get('daily_requests', 0),
-                        state.get('interview_stage', 0),
-                    ])
-                except Exception as e:
-                    logger.warning(f"History write error: {e}")
+            enqueue_history(user_id, state.get('scenario') or '', 'assistant', next_q, state)
         else:
             # Интервью завершено - переходим к AI
             completion_message = (
@@ -1323,20 +3063,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             await update.message.reply_text(completion_message)
             state['conversation_history'].append({"role": "assistant", "content": completion_message})
-            if history_sheet:
-                try:
-                    history_sheet.append_row([
-                        user_id,
-                        state.get('scenario') or '',
-                            now_msk_str(),
-                        'assistant',
-                        completion_message,
-                        state.get('free_used', 0),
-                        state.get('daily_requests', 0),
-                        state.get('interview_stage', 0),
-                    ])
-                except Exception as e:
-                    logger.warning(f"History write error: {e}")
+            enqueue_history(user_id, state.get('scenario') or '', 'assistant', completion_message, state)
         
         # Persist
         if persistence:
@@ -1349,6 +3076,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Проверяем лимиты
     scenario_cfg = SCENARIOS.get(state.get('scenario')) if state.get('scenario') else None
+    counted_daily = False
     # Если активна подписка - лимиты отключены
     if is_subscription_active(state):
         pass
@@ -1361,6 +3089,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         daily_limit = state.get('custom_limit', 10)
         if state.get('daily_requests', 0) >= daily_limit:
+            limit_hits_total.inc('daily')
             if not state.get('limit_notified'):
                 await update.message.reply_text(
                     f"Дневной лимит исчерпан ({daily_limit} запросов). Попробуйте завтра или обратитесь к администратору."
@@ -1375,63 +3104,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         state['daily_requests'] = state.get('daily_requests', 0) + 1
+        counted_daily = True
     else:
         # Сценарий с total_free лимитом - проверка уже выполнена выше
         pass
 
     # Только теперь показываем индикатор размышления, если реально идём к ИИ
-    await update.message.reply_text("💭 Думаю...")
-    
-    # Запрос к AI
-    ai_response = await deepseek_request(
-        user_message, 
-        user_history=state.get('conversation_history'),
-        user_data=state
-    )
-    
-    if ai_response:
-        await update.message.reply_text(ai_response)
-        state['conversation_history'].append({"role": "assistant", "content": ai_response})
-        
-        # Увеличиваем счетчик бесплатных использований для total_free сценариев
-        if scenario_cfg and scenario_cfg.get('limit_mode') == 'total_free':
-            state['free_used'] = state.get('free_used', 0) + 1
-            
-            # Если достигли лимита - предлагаем оплату
-            if state['free_used'] >= scenario_cfg.get('limit_value', 5):
-                if not state.get('limit_notified'):
-                    limit_msg = scenario_cfg.get('limit_message', 'Лимит исчерпан.')
-                    await update.message.reply_text(limit_msg)
-                    state['conversation_history'].append({"role": "assistant", "content": limit_msg})
-                    state['limit_notified'] = True
-                    
-                    # Предлагаем оплату
-                    try:
-                        await send_invoice_to_user(context, user_id)
-                    except Exception as e:
-                        logger.warning(f"Auto-invoice tg error: {e}")
-                    # Параллельно предложим оплату через redirect/СБП (прямая ссылка)
-                    try:
-                        await send_sbp_link(context, user_id)
-                    except Exception as e:
-                        logger.warning(f"Auto-invoice sbp error: {e}")
-            return
-        elif free_used >= free_limit:
-            # Лимит уже показан ранее - просто блокируем доступ без запроса к ИИ
-            return
-
-    # Только теперь показываем индикатор размышления, если реально идём к ИИ
-    await update.message.reply_text("💭 Думаю...")
-    
-    # Запрос к AI
-    ai_response = await deepseek_request(
-        user_message, 
-        user_history=state.get('conversation_history'),
-        user_data=state
-    )
+    # Запрос к AI (ответ отправляется/дописывается в плейсхолдер внутри)
+    try:
+        ai_response = await answer_with_ai(update, user_message, state)
+    except LLMQueueFull:
+        # Отказ из-за перегрузки - запрос не засчитываем
+        if counted_daily:
+            state['daily_requests'] = max(0, state.get('daily_requests', 0) - 1)
+        return
     
     if ai_response:
-        await update.message.reply_text(ai_response)
         state['conversation_history'].append({"role": "assistant", "content": ai_response})
         
         # Увеличиваем счетчик бесплатных использований для total_free сценариев
@@ -1457,23 +3145,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     except Exception as e:
                         logger.warning(f"Auto-invoice sbp error: {e}")
     else:
+        # Ответа нет - запрос не засчитываем в дневной лимит
+        if counted_daily:
+            state['daily_requests'] = max(0, state.get('daily_requests', 0) - 1)
         await update.message.reply_text("Извините, произошла ошибка. Попробуйте позже.")
     
     # Сохраняем ответ в историю
-    if history_sheet:
-        try:
-            history_sheet.append_row([
-                user_id,
-                state.get('scenario') or '',
-                            now_msk_str(),
-                'assistant',
-                ai_response or "Ошибка",
-                state.get('free_used', 0),
-                state.get('daily_requests', 0),
-                state.get('interview_stage', 0),
-            ])
-        except Exception as e:
-            logger.warning(f"History write error: {e}")
+    enqueue_history(user_id, state.get('scenario') or '', 'assistant', ai_response or "Ошибка", state)
     
     # Persist
     if persistence:
@@ -1487,7 +3165,49 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_CHAT_ID:
         return
-    await update.message.reply_text(f"Пользователей: {len(user_states)}")
+    await update.message.reply_text(
+        f"Пользователей: {len(user_states)}\n"
+        f"История в памяти: {conversation_memory_bytes() / 1024:.0f} КБ\n"
+        f"RSS процесса: {process_rss_bytes() / 1024 / 1024:.0f} МБ\n"
+        f"LLM: в работе {llm_admission.in_flight}/{llm_admission.max_in_flight}, "
+        f"в очереди {llm_admission.queued}, отказов {llm_admission.rejected}, "
+        f"ожидание avg {llm_admission.wait_total / max(1, llm_admission.admitted):.2f}s max {llm_admission.wait_max:.2f}s\n"
+        f"Дубли апдейтов отброшено: {update_dedup.duplicates}\n"
+        f"Приём: очередь {ingest.depth}/{ingest.max_queue}, в обработке {ingest.in_process}, "
+        f"сброшено {ingest.shed}, критичных {ingest.critical}\n"
+        f"Вебхук: {webhook_supervisor.state}, проверок {webhook_supervisor.checks} (пропущено {webhook_supervisor.skipped}), "
+        f"перерегистраций {webhook_supervisor.registrations}\n"
+        f"Sync-пул: очередь {blocking.queue_depth}, в работе {blocking.running}/{blocking.max_workers}\n"
+        f"DeepSeek: {deepseek_breaker.state}, "
+        + (", ".join(f"{k}={v}" for k, v in sorted(deepseek_outcomes.items())) or "нет запросов")
+    )
+
+async def admin_traces(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/traces - последние сохранённые трассы (самые медленные сверху), /traces <id> - разбивка по интервалам."""
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        return
+    if context.args:
+        trace = tracer.find(context.args[0])
+        if not trace:
+            await update.message.reply_text("Трасса не найдена")
+            return
+        d = trace.to_dict()
+        lines = [f"{d['id']} {d.get('kind', '-')} user {d.get('user_id', '-')}: {d['duration_ms']:.0f} ms"
+                 + (f", в очереди {d['queued_ms']:.0f} ms" if d.get('queued_ms') is not None else '')]
+        for sp in d['spans']:
+            extra = ' '.join(f"{k}={v}" for k, v in sp.items() if k not in ('name', 'start_ms', 'duration_ms'))
+            lines.append(f"+{sp['start_ms']:.0f} {sp['name']} {sp['duration_ms']:.0f} ms {extra}".rstrip())
+        await update.message.reply_text('\n'.join(lines)[:TG_MESSAGE_LIMIT])
+        return
+    traces = sorted(list(tracer.ring)[-20:], key=lambda t: t.duration or 0, reverse=True)
+    if not traces:
+        await update.message.reply_text(f"Трасс нет (всего апдейтов: {tracer.finished})")
+        return
+    lines = [f"Трассы (из {tracer.finished} апдейтов, интервалов после конца трассы: {tracer.late_spans}):"]
+    for t in traces:
+        lines.append(f"{t.id} {t.attrs.get('kind', '-')} {t.attrs.get('user_id', '-')} {t.duration * 1000:.0f} ms"
+                     + (' ❌' if t.error else ''))
+    await update.message.reply_text('\n'.join(lines))
 
 async def admin_block(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_CHAT_ID:
@@ -1548,269 +3268,884 @@ async def admin_whitelist(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.exception("Unhandled exception in handler", exc_info=context.error)
 
-# === ЗАПУСК ===
-def main():
-    logger.info("Starting MetaPersona Bot...")
+# === ОБРАБОТКА ОБНОВЛЕНИЙ ===
+class UpdateDeduplicator:
+    """Недавно принятые update_id (ограниченный LRU + окно по времени) - отсекает ретраи Telegram."""
 
-    async def run_server():
-        # Build application without Updater (custom webhook server)
-        application = Application.builder().updater(None).token(BOT_TOKEN).build()
-
-        # Handlers
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        application.add_handler(CommandHandler("stats", admin_stats))
-        application.add_handler(CommandHandler("block", admin_block))
-        application.add_handler(CommandHandler("unblock", admin_unblock))
-        application.add_handler(CommandHandler("setlimit", admin_setlimit))
-        application.add_handler(CommandHandler("notify", admin_notify))
-        application.add_handler(CommandHandler("echo", admin_echo))
-        application.add_handler(CommandHandler("whitelist", admin_whitelist))
-        application.add_error_handler(error_handler)
-
-        # Admin diagnostics
-        async def diag_webhook(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            if update.effective_user.id != ADMIN_CHAT_ID:
-                return
+    def __init__(self, max_size: int, window_secs: float):
+        self.max_size = max_size
+        self.window_secs = window_secs
+        self._seen: OrderedDict[int, float] = OrderedDict()
+        self.duplicates = 0
+
+    def is_duplicate(self, update_id) -> bool:
+        if update_id is None:
+            return False
+        now = time.monotonic()
+        # выкидываем устаревшие и лишние записи с головы
+        while self._seen:
+            seen_at = next(iter(self._seen.values()))
+            if len(self._seen) < self.max_size and now - seen_at < self.window_secs:
+                break
+            self._seen.popitem(last=False)
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        self._seen[update_id] = now
+        return False
+
+update_dedup = UpdateDeduplicator(UPDATE_DEDUP_SIZE, UPDATE_DEDUP_SECS)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает апдейты разных пользователей параллельно, а апдейты одного пользователя - строго по очереди.
+
+    Глобальный слот (max_concurrent_updates) берётся только после лока пользователя, поэтому апдейты,
+    ждущие своей очереди, не занимают слоты других пользователей. Pre-checkout и успешная оплата идут
+    мимо очереди пользователя и потолка: на pre-checkout Telegram ждёт ответа не дольше 10 секунд.
+    Лок пользователя удаляется, когда у него не остаётся ожидающих апдейтов.
+    """
+
+    def __init__(self, max_concurrent_updates: int, on_done=None):
+        super().__init__(max_concurrent_updates)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # key -> [lock, число апдейтов, удерживающих/ожидающих лок]
+        self._user_locks: dict[int, list] = {}
+        # вызывается с апдейтом после его обработки (освобождает место в стадии приёма)
+        self.on_done = on_done
+
+    @staticmethod
+    def _update_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    @staticmethod
+    def _is_payment(update: object) -> bool:
+        return isinstance(update, Update) and bool(
+            update.pre_checkout_query or (update.message and update.message.successful_payment)
+        )
+
+    async def process_update(self, update: object, coroutine) -> None:
+        # семафор базового класса не используем: слот берётся в _process_in_order после лока пользователя
+        await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        trace, token = tracer.begin(**self._trace_attrs(update))
+        try:
+            await self._process_in_order(update, coroutine)
+        finally:
+            tracer.end(trace, token)
+            if self.on_done:
+                self.on_done(update)
+
+    def _trace_attrs(self, update: object) -> dict:
+        if not isinstance(update, Update):
+            return {'kind': type(update).__name__}
+        attrs = {'update_id': update.update_id, 'user_id': self._update_key(update)}
+        if update.message:
+            text = update.message.text or ''
+            attrs['kind'] = text.split()[0][:32] if text.startswith('/') else 'message'
+        elif update.callback_query:
+            attrs['kind'] = 'callback'
+        else:
+            attrs['kind'] = 'other'
+        received = ingest.received_at(update.update_id)
+        if received is not None:
+            attrs['queued_ms'] = round((time.monotonic() - received) * 1000, 1)
+        return attrs
+
+    async def _process_in_order(self, update: object, coroutine) -> None:
+        if self._is_payment(update):
+            await coroutine
+            return
+        key = self._update_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self._user_locks.get(key) is entry:
+                del self._user_locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._user_locks.clear()
+
+class IngestStage:
+    """Стадия приёма вебхуков между aiohttp и очередью PTB.
+
+    Вебхук только разбирает JSON и кладёт тело в ограниченную очередь (ответ 200 сразу).
+    Насос передаёт апдейты в PTB, пока в обработке меньше max_in_process. При переполнении
+    некритичные апдейты сбрасываются; оплаты, pre-checkout и команды админа принимаются всегда
+    и идут вне очереди. При остановке новые вебхуки получают 503 (Telegram повторит доставку),
+    а уже принятые передаются в PTB и дообрабатываются в application.stop().
+    Пока идёт восстановление состояний, апдейты пользователей откладываются (см. restored()).
+    """
+
+    def __init__(self, max_queue: int, max_in_process: int):
+        self.max_queue = max_queue
+        self.max_in_process = max_in_process
+        self._critical: deque = deque()
+        self._normal: deque = deque()
+        # апдейты, отложенные до конца восстановления состояний
+        self._held: deque = deque()
+        self.restoring = True
+        self.in_process = 0
+        self.accepted = 0
+        self.shed = 0
+        self.critical = 0
+        # update_id -> время приёма вебхука (для гистограммы латентности)
+        self._received: dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.closing = False
+
+    @property
+    def depth(self) -> int:
+        return len(self._critical) + len(self._normal)
+
+    @staticmethod
+    def is_critical(body: dict) -> bool:
+        if body.get('pre_checkout_query'):
+            return True
+        msg = body.get('message') or {}
+        if msg.get('successful_payment'):
+            return True
+        if (msg.get('from') or {}).get('id') == ADMIN_CHAT_ID and (msg.get('text') or '').startswith('/'):
+            return True
+        cq = body.get('callback_query') or {}
+        return (cq.get('data') or '').startswith('yk_')
+
+    def _waits_for_restore(self, body: dict) -> bool:
+        """До конца восстановления ждут все апдейты, кроме pre-checkout (он состояние не трогает и ждать не может).
+
+        Незнакомому пользователю start() создал бы пустое состояние, а пользователь из снимка обработался бы
+        по устаревшему состоянию - и то и другое затёрло бы более свежую строку из Sheets.
+        """
+        return self.restoring and not body.get('pre_checkout_query')
+
+    def restored(self):
+        """Восстановление закончено (или не удалось): отложенные апдейты идут в обработку первыми."""
+        self.restoring = False
+        if self._held:
+            logger.info(f"Releasing {len(self._held)} updates held until state restore")
+            self._normal.extendleft(reversed(self._held))
+            self._held.clear()
+            self._wakeup.set()
+
+    def offer(self, body: dict) -> bool:
+        """Кладёт апдейт в очередь; False - апдейт сброшен из-за перегрузки."""
+        if self.is_critical(body):
+            self.critical += 1
+            self._critical.append(body)
+        elif self.depth + len(self._held) >= self.max_queue:
+            self.shed += 1
+            return False
+        else:
+            self._normal.append(body)
+        self.accepted += 1
+        self._received[body.get('update_id')] = time.monotonic()
+        self._wakeup.set()
+        return True
+
+    def received_at(self, update_id) -> float | None:
+        return self._received.get(update_id)
+
+    def done(self, update=None):
+        self.in_process = max(0, self.in_process - 1)
+        received = self._received.pop(getattr(update, 'update_id', None), None)
+        if received is not None:
+            update_latency.observe(time.monotonic() - received)
+        self._wakeup.set()
+
+    def start(self, application: Application):
+        if not self._task:
+            self._task = asyncio.create_task(self._pump(application))
+
+    async def stop(self, application: Application):
+        """Перестаёт принимать вебхуки и передаёт всё принятое в update_queue до application.stop()."""
+        self.closing = True
+        if self._task:
+            self._task.cancel()
             try:
-                info = await application.bot.get_webhook_info()
-                txt = (
-                    f"url: {info.url or '-'}\n"
-                    f"has_custom_certificate: {info.has_custom_certificate}\n"
-                    f"pending_update_count: {info.pending_update_count}\n"
-                    f"ip_address: {getattr(info, 'ip_address', '-') }\n"
-                    f"last_error_date: {getattr(info, 'last_error_date', '-') }\n"
-                    f"last_error_message: {getattr(info, 'last_error_message', '-') }"
-                )
-                await update.message.reply_text(f"Webhook info:\n{txt}")
-            except Exception as e:
-                await update.message.reply_text(f"diag_webhook error: {e}")
+                await self._task
+            except BaseException:
+                pass
+            self._task = None
+        if self._held:
+            # состояния этих пользователей так и не восстановлены - обработка затёрла бы их
+            logger.warning(f"Ingest stopped before state restore: {len(self._held)} held updates dropped")
+            for body in self._held:
+                self._received.pop(body.get('update_id'), None)
+            self._held.clear()
+        if not self.depth:
+            return
+        if not application.running:
+            logger.warning(f"Ingest stopped before Telegram started: {self.depth} updates dropped")
+            self._critical.clear()
+            self._normal.clear()
+            return
+        handed = 0
+        while self.depth:
+            body = self._pop()
+            if self._waits_for_restore(body):
+                self._received.pop(body.get('update_id'), None)
+                continue
+            if await self._hand_over(application, body):
+                handed += 1
+        logger.info(f"Ingest drained: {handed} queued updates handed to PTB")
 
-        async def reset_webhook(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            if update.effective_user.id != ADMIN_CHAT_ID:
-                return
+    def _pop(self) -> dict:
+        return self._critical.popleft() if self._critical else self._normal.popleft()
+
+    async def _hand_over(self, application: Application, body: dict) -> bool:
+        try:
+            update = Update.de_json(body, application.bot)
+        except Exception as e:
+            logger.warning(f"Update parse error: {e}")
+            self._received.pop(body.get('update_id'), None)
+            return False
+        self.in_process += 1
+        await application.update_queue.put(update)
+        return True
+
+    async def _pump(self, application: Application):
+        while True:
+            if not self.depth or self.in_process >= self.max_in_process:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            body = self._pop()
+            if self._waits_for_restore(body):
+                self._held.append(body)
+                continue
+            await self._hand_over(application, body)
+
+ingest = IngestStage(INGEST_QUEUE_MAX, INGEST_MAX_IN_PROCESS)
+
+def overload_reply(body: dict) -> web.Response:
+    """Ответ на сброшенный апдейт: просим Telegram прямо в ответе вебхука отправить «занято» (без лишнего запроса к API)."""
+    chat_id = ((body.get('message') or {}).get('chat') or {}).get('id')
+    if not chat_id:
+        return web.Response(text="OK")
+    return web.json_response({"method": "sendMessage", "chat_id": chat_id, "text": LLM_BUSY_MESSAGE})
+
+class WebhookSupervisor:
+    """Следит за вебхуком Telegram и перерегистрирует его при проблемах.
+
+    Интервал проверки удваивается, пока всё в порядке (до max_secs), и сбрасывается до min_secs
+    после проблем. Если с прошлой проверки вебхуки доходили, getWebhookInfo не вызывается вовсе.
+    Перерегистрация - при смене URL, новом last_error_date или накопившемся pending_update_count
+    без доставок. Состояние отдаётся в /health.
+    """
+
+    def __init__(self, min_secs: float, max_secs: float, pending_max: int):
+        self.min_secs = max(1.0, min_secs)
+        self.max_secs = max(self.min_secs, max_secs)
+        self.pending_max = pending_max
+        self.interval = self.min_secs
+        self.state = 'starting'
+        self.expected_url = ''
+        self.checks = 0
+        self.skipped = 0
+        self.registrations = 0
+        self.pending_update_count = None
+        self.last_error_date = None
+        self.last_error_message = None
+        self.last_check_at = None
+        self.last_delivery_at = None
+        self._delivered_since_check = False
+        self._bot = None
+        self._urls: list[tuple[str, str | None]] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def configure(self, bot, short_url: str, token_url: str, secret: str | None):
+        self._bot = bot
+        # сначала короткий путь с секретом, запасной - путь с токеном
+        self._urls = [(short_url, secret), (token_url, None)] if secret else [(token_url, None)]
+        self.expected_url = self._urls[0][0]
+
+    def delivered(self):
+        """Вызывается на каждый принятый вебхук - доставка работает."""
+        self.last_delivery_at = time.time()
+        self._delivered_since_check = True
+
+    def poke(self):
+        """Внеплановая проверка как можно скорее."""
+        self.interval = self.min_secs
+        self._wakeup.set()
+
+    async def register(self, drop_pending: bool = False) -> bool:
+        for url, secret in self._urls:
             try:
-                base_url = os.environ.get('WEBHOOK_BASE_URL') or os.environ.get('RENDER_EXTERNAL_URL')
-                if not base_url:
-                    await update.message.reply_text('WEBHOOK_BASE_URL/RENDER_EXTERNAL_URL не задан')
-                    return
-                url_path = f"/webhook/{BOT_TOKEN}"
-                webhook_url = base_url.rstrip('/') + url_path
-                await application.bot.set_webhook(webhook_url, drop_pending_updates=True)
-                await update.message.reply_text(f"Webhook reset to: {webhook_url}")
+                await self._bot.set_webhook(url, secret_token=secret, drop_pending_updates=drop_pending, allowed_updates=Update.ALL_TYPES)
+                self.expected_url = url
+                self.registrations += 1
+                logger.info(f"Webhook set to: {url}")
+                return True
             except Exception as e:
-                await update.message.reply_text(f"reset_webhook error: {e}")
+                logger.warning(f"set_webhook {url} failed: {e}")
+        self.state = 'failing'
+        return False
+
+    async def check(self):
+        if self._delivered_since_check and self.state == 'ok':
+            # Telegram доставляет апдейты - URL верный, вызов API не нужен
+            self._delivered_since_check = False
+            self.skipped += 1
+            self.interval = min(self.interval * 2, self.max_secs)
+            return
+        self._delivered_since_check = False
+        info = await self._bot.get_webhook_info()
+        self.checks += 1
+        self.last_check_at = time.time()
+        self.pending_update_count = info.pending_update_count
+        problem = None
+        if info.url != self.expected_url:
+            problem = f"url mismatch: expected {self.expected_url}, got {info.url or '-'}"
+        error_ts = info.last_error_date.timestamp() if info.last_error_date else None
+        if error_ts and error_ts != self.last_error_date:
+            self.last_error_date = error_ts
+            self.last_error_message = info.last_error_message
+            problem = problem or f"delivery error: {info.last_error_message}"
+        if info.pending_update_count >= self.pending_max and not self._delivered_recently():
+            problem = problem or f"{info.pending_update_count} pending updates without deliveries"
+        if problem:
+            logger.warning(f"Webhook problem, re-registering: {problem}")
+            self.state = 'degraded' if await self.register() else 'failing'
+            self.interval = self.min_secs
+        else:
+            self.state = 'ok'
+            self.interval = min(self.interval * 2, self.max_secs)
+
+    def _delivered_recently(self) -> bool:
+        return bool(self.last_delivery_at) and time.time() - self.last_delivery_at < self.interval
 
-        application.add_handler(CommandHandler("diag", diag_webhook))
-        application.add_handler(CommandHandler("reset", reset_webhook))
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
 
-        # PreCheckoutQuery handler
-        async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            query = update.pre_checkout_query
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
             try:
-                await query.answer(ok=True)
-            except Exception:
-                await query.answer(ok=False, error_message="Ошибка при обработке оплаты. Попробуйте позже.")
+                await self._task
+            except BaseException:
+                pass
+            self._task = None
 
-        async def successful_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            user_id = update.effective_user.id
-            payment = update.message.successful_payment
-            
-            # Активируем подписку
-            until = (datetime.now(MSK_TZ) + timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
-            if user_id in user_states:
-                user_states[user_id]['is_subscribed'] = True
-                user_states[user_id]['subscription_until'] = until
-                user_states[user_id]['limit_notified'] = False
-                user_states[user_id]['subscription_end_notified'] = False
-                # Обновляем данные в таблице
-                update_user_subscription_in_sheet(user_id, user_states[user_id])
-                user_states[user_id]['last_payment_id'] = payment.telegram_payment_charge_id
-                
-                # Persist
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.check()
+            except Exception as e:
+                self.state = 'degraded'
+                self.interval = self.min_secs
+                logger.warning(f"Webhook check error: {e}")
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        return {
+            'status': self.state,
+            'pending_update_count': self.pending_update_count,
+            'last_error_date': self.last_error_date,
+            'last_error_message': self.last_error_message,
+            'last_check_ago': round(now - self.last_check_at, 1) if self.last_check_at else None,
+            'last_delivery_ago': round(now - self.last_delivery_at, 1) if self.last_delivery_at else None,
+            'next_check_in': round(self.interval, 1),
+            'checks': self.checks,
+            'skipped_checks': self.skipped,
+            'registrations': self.registrations,
+            'ingest_depth': ingest.depth,
+        }
+
+webhook_supervisor = WebhookSupervisor(WEBHOOK_CHECK_MIN_SECS, WEBHOOK_CHECK_MAX_SECS, WEBHOOK_PENDING_MAX)
+
+# Метрики, которые читаются из уже существующих счётчиков в момент выгрузки
+metrics.gauge_fn('bot_users', 'Users in memory', lambda: len(user_states))
+metrics.gauge_fn('bot_conversation_memory_bytes', 'Conversation history held in memory', conversation_memory_bytes)
+metrics.gauge_fn('bot_process_rss_bytes', 'Process resident memory', process_rss_bytes)
+metrics.gauge_fn('bot_update_queue_depth', 'Updates waiting in the ingest stage', lambda: ingest.depth)
+metrics.gauge_fn('bot_updates_in_process', 'Updates handed to PTB and not finished', lambda: ingest.in_process)
+metrics.gauge_fn('bot_llm_in_flight', 'LLM calls in flight', lambda: llm_admission.in_flight)
+metrics.gauge_fn('bot_llm_queued', 'LLM calls waiting for a slot', lambda: llm_admission.queued)
+metrics.gauge_fn('bot_sync_queue_depth', 'Blocking calls waiting for a pool thread', lambda: blocking.queue_depth)
+metrics.gauge_fn('bot_deepseek_breaker_open', 'DeepSeek circuit breaker is not closed', lambda: int(deepseek_breaker.state != 'closed'))
+metrics.counter_fn('bot_updates_accepted_total', 'Updates accepted by the ingest stage', lambda: ingest.accepted)
+metrics.counter_fn('bot_updates_shed_total', 'Updates dropped on overload', lambda: ingest.shed)
+metrics.counter_fn('bot_updates_duplicate_total', 'Telegram retries dropped by update_id', lambda: update_dedup.duplicates)
+metrics.counter_fn('bot_llm_rejected_total', 'LLM calls rejected with a full queue', lambda: llm_admission.rejected)
+metrics.counter_fn('bot_llm_admitted_total', 'LLM calls admitted', lambda: llm_admission.admitted)
+metrics.counter_fn('bot_llm_wait_seconds_total', 'Total time spent waiting for an LLM slot', lambda: llm_admission.wait_total)
+metrics.counter_fn('bot_deepseek_outcomes_total', 'DeepSeek HTTP attempts by outcome',
+                   lambda: {(k,): v for k, v in deepseek_outcomes.items()}, ('outcome',))
+metrics.counter_fn('bot_webhook_registrations_total', 'setWebhook calls made by the supervisor', lambda: webhook_supervisor.registrations)
+
+# === ЗАПУСК ===
+class StartupPhases:
+    """Время фаз запуска (в лог и в /health) и готовность фоновой инициализации."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases: dict[str, float] = {}
+        self.failed: dict[str, str] = {}
+        self.ready = False
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.failed[name] = str(e)[:200]
+            raise
+        finally:
+            self.record(name, time.monotonic() - started)
+
+    def record(self, name: str, secs: float):
+        self.phases[name] = secs
+        logger.info(f"Startup phase {name}: {secs * 1000:.0f} ms")
+
+    def snapshot(self) -> dict:
+        return {
+            'ready': self.ready,
+            'uptime': round(time.monotonic() - self.started, 1),
+            'phases_ms': {k: round(v * 1000) for k, v in self.phases.items()},
+            'failed': self.failed,
+        }
+
+startup = StartupPhases()
+
+def state_is_recent(state: dict, days: int = 14) -> bool:
+    last_at = state.get('last_activity_at') or state.get('updated_at')
+    if last_at:
+        try:
+            dt = datetime.strptime(last_at, '%Y-%m-%d %H:%M:%S')
+            if (datetime.now(MSK_TZ) - dt).days > days:
+                return False
+        except Exception:
+            pass
+    return True
+
+async def apply_restored_states(states: dict[int, dict], newer_only: bool = False) -> int:
+    """Кладёт восстановленные состояния в user_states (активность за последние 14 дней).
+
+    До конца восстановления стадия приёма апдейты пользователей не пропускает, поэтому в user_states
+    лежат только состояния из снимка, не изменённые в этом процессе.
+    newer_only: сверка со снимком - строки Sheets с updated_at не раньше снимка заменяют его состояния;
+    иначе уже известные состояния не трогаем.
+    """
+    applied = 0
+    for i, (uid, st) in enumerate(states.items(), start=1):
+        if i % 500 == 0:
+            # тысячи состояний не должны держать event loop (приём вебхуков, /health)
+            await asyncio.sleep(0)
+        if not state_is_recent(st):
+            continue
+        current = user_states.get(uid)
+        if current is not None:
+            if not newer_only:
+                continue
+            st['conversation_history'] = current.get('conversation_history')
+        ensure_conversation(uid, st)
+        user_states[uid] = st
+        applied += 1
+    return applied
+
+async def restore_snapshot():
+    """Тёплый старт: состояния из локального снимка, до подключения Sheets (чтение и разбор - в пуле)."""
+    if state_snapshot:
+        await apply_restored_states(await blocking.run('Snapshot', state_snapshot.load))
+
+async def restore_states() -> bool:
+    """Восстанавливает состояния пользователей из хранилища; False - если восстановить не удалось.
+
+    Если на старте загружен локальный снимок, из Sheets читаются только строки, изменённые после него.
+    """
+    if not persistence:
+        return False
+    try:
+        if state_snapshot and state_snapshot.saved_at and persistence is sheets_persistence:
+            changed = await blocking.run('States', persistence.load_changed_since, state_snapshot.saved_at)
+            applied = await apply_restored_states(changed, newer_only=True)
+            logger.info(f"Reconciled {applied} user states changed since snapshot {state_snapshot.saved_at}")
+        else:
+            all_states = await blocking.run('States', persistence.load_all_states)
+            logger.info(f"Restored {await apply_restored_states(all_states)} user states")
+        return True
+    except Exception as e:
+        logger.warning(f"States restore error: {e}")
+        return False
+
+async def start_services(application: Application, short_url: str, token_url: str, stop: asyncio.Event):
+    """Фоновая инициализация после того, как сервер уже слушает порт.
+
+    Telegram (initialize, setWebhook), Google Sheets и YooKassa поднимаются параллельно. Вебхуки тем
+    временем копятся в стадии приёма; обработка начинается после восстановления состояний или по
+    STARTUP_RESTORE_TIMEOUT - тогда насос запускается для pre-checkout, а апдейты пользователей ждут
+    конца восстановления (IngestStage.restored).
+    """
+    async def telegram():
+        with startup.phase('telegram'):
+            await application.initialize()
+            await application.start()
+        if not short_url:
+            # без публичного адреса регистрировать нечего: относительный URL Telegram не примет,
+            # а супервизор перерегистрировал бы его бесконечно
+            webhook_supervisor.state = 'disabled'
+            logger.warning('WEBHOOK_BASE_URL/RENDER_EXTERNAL_URL not set, webhook is not registered')
+            return
+        with startup.phase('webhook'):
+            # Prefer short path with secret if configured; fallback to token path; don't crash on failure
+            webhook_supervisor.configure(application.bot, short_url, token_url, WEBHOOK_SECRET)
+            await webhook_supervisor.register()
+            webhook_supervisor.start()
+
+    async def storage():
+        with startup.phase('local'):
+            # чтение и разбор лога и снимка - в пуле, на event loop только подстановка результата
+            recent_history.loaded(*await blocking.run('RecentHistory', recent_history.read))
+            recent_history.start()
+            await restore_snapshot()
+        if GOOGLE_CREDENTIALS_JSON:
+            try:
+                with startup.phase('sheets'):
+                    attach_sheets(*await blocking.run('Sheets', connect_sheets))
+                logger.info('Google Sheets connected')
+            except Exception as e:
+                logger.warning(f"Google Sheets error: {e}")
+        try:
+            with startup.phase('restore'):
+                if history_writer:
+                    history_writer.start()
                 if persistence:
-                    try:
-                        user_states[user_id]['last_activity_at'] = now_msk_str()
-                        persistence.save_user_state(user_id, user_states[user_id], force=True)
-                    except Exception as e:
-                        logger.warning(f"Persist save error: {e}")
-                
-                # Отправляем приветственное сообщение
-                scenario_cfg = SCENARIOS.get(user_states[user_id].get('scenario'))
-                if scenario_cfg and scenario_cfg.get('subscription_welcome'):
-                    welcome_msg = scenario_cfg['subscription_welcome']
-                    await update.message.reply_text(welcome_msg)
-                    user_states[user_id]['conversation_history'].append({"role": "assistant", "content": welcome_msg})
-                else:
-                    await update.message.reply_text("Оплата получена, доступ активирован.")
-                
-                # Уведомляем админа
-                try:
-                    await context.bot.send_message(
-                        chat_id=ADMIN_CHAT_ID,
-                        text=f"💰 Оплата от {user_id}: {payment.total_amount/100} {payment.currency}"
-                    )
-                except Exception as e:
-                    logger.warning(f"Admin payment notify error: {e}")
+                    persistence.start()
+                if users_index:
+                    await blocking.run('Users', users_index.build)
+                await blocking.run('History', ensure_history_headers)
+                if await restore_states() and state_snapshot:
+                    state_snapshot.start()
+        except Exception as e:
+            logger.warning(f"Restore phase error: {e}")
+        ingest.restored()
 
-        application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-        application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
+    async def payments():
+        with startup.phase('yookassa'):
+            init_yookassa()
 
-        # Callback for external YooKassa Smart Payment (create redirect payment)
-        async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            if not update.callback_query:
-                return
-            cq = update.callback_query
-            data = cq.data or ''
-            if not data.startswith('yk_redirect:'):
+    storage_task = asyncio.create_task(storage())
+    payments_task = asyncio.create_task(payments())
+    try:
+        await telegram()
+        try:
+            await asyncio.wait_for(asyncio.shield(storage_task), STARTUP_RESTORE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"State restore takes longer than {STARTUP_RESTORE_TIMEOUT:.0f}s, holding user updates until it finishes")
+        ingest.start(application)
+        await asyncio.gather(storage_task, payments_task, return_exceptions=True)
+    except BaseException as e:
+        storage_task.cancel()
+        payments_task.cancel()
+        if isinstance(e, Exception):
+            # без Bot API бот бесполезен - останавливаемся, платформа перезапустит
+            logger.exception(f"Telegram startup error: {e}")
+            stop.set()
+            return
+        raise
+    startup.ready = True
+    logger.info(f"Startup complete in {(time.monotonic() - startup.started) * 1000:.0f} ms")
+
+async def run_server(stop: asyncio.Event | None = None):
+    """Поднимает бота и aiohttp-сервер и работает до stop (по умолчанию - до SIGINT/SIGTERM)."""
+    bind_started = time.monotonic()
+    # Build application without Updater (custom webhook server)
+    application = (
+        Application.builder()
+        .updater(None)
+        .token(BOT_TOKEN)
+        .base_url(f"{TELEGRAM_BASE_URL}/bot")
+        .base_file_url(f"{TELEGRAM_BASE_URL}/file/bot")
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES, on_done=ingest.done))
+        .request(TracedHTTPXRequest(connection_pool_size=256))
+        .build()
+    )
+
+    # Handlers
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(CommandHandler("stats", admin_stats))
+    application.add_handler(CommandHandler("traces", admin_traces))
+    application.add_handler(CommandHandler("block", admin_block))
+    application.add_handler(CommandHandler("unblock", admin_unblock))
+    application.add_handler(CommandHandler("setlimit", admin_setlimit))
+    application.add_handler(CommandHandler("notify", admin_notify))
+    application.add_handler(CommandHandler("echo", admin_echo))
+    application.add_handler(CommandHandler("whitelist", admin_whitelist))
+    application.add_error_handler(error_handler)
+
+    # Admin diagnostics
+    async def diag_webhook(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id != ADMIN_CHAT_ID:
+            return
+        try:
+            info = await application.bot.get_webhook_info()
+            txt = (
+                f"url: {info.url or '-'}\n"
+                f"has_custom_certificate: {info.has_custom_certificate}\n"
+                f"pending_update_count: {info.pending_update_count}\n"
+                f"ip_address: {getattr(info, 'ip_address', '-') }\n"
+                f"last_error_date: {getattr(info, 'last_error_date', '-') }\n"
+                f"last_error_message: {getattr(info, 'last_error_message', '-') }"
+            )
+            await update.message.reply_text(f"Webhook info:\n{txt}")
+        except Exception as e:
+            await update.message.reply_text(f"diag_webhook error: {e}")
+
+    async def reset_webhook(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id != ADMIN_CHAT_ID:
+            return
+        try:
+            base_url = os.environ.get('WEBHOOK_BASE_URL') or os.environ.get('RENDER_EXTERNAL_URL')
+            if not base_url:
+                await update.message.reply_text('WEBHOOK_BASE_URL/RENDER_EXTERNAL_URL не задан')
                 return
-            await cq.answer()
-            if not (YOOKASSA_ACCOUNT_ID and YOOKASSA_SECRET_KEY and YOOKASSA_RETURN_URL):
-                await cq.message.reply_text("Ссылка на оплату временно недоступна")
+            if not await webhook_supervisor.register(drop_pending=True):
+                await update.message.reply_text('reset_webhook: set_webhook failed')
                 return
+            await update.message.reply_text(f"Webhook reset to: {webhook_supervisor.expected_url}")
+        except Exception as e:
+            await update.message.reply_text(f"reset_webhook error: {e}")
+
+    application.add_handler(CommandHandler("diag", diag_webhook))
+    application.add_handler(CommandHandler("reset", reset_webhook))
+
+    # PreCheckoutQuery handler
+    async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.pre_checkout_query
+        try:
+            await query.answer(ok=True)
+        except Exception:
+            await query.answer(ok=False, error_message="Ошибка при обработке оплаты. Попробуйте позже.")
+
+    async def successful_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        payment = update.message.successful_payment
+        payments_total.inc('telegram')
+        
+        # Активируем подписку
+        until = (datetime.now(MSK_TZ) + timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
+        if user_id in user_states:
+            user_states[user_id]['is_subscribed'] = True
+            user_states[user_id]['subscription_until'] = until
+            user_states[user_id]['limit_notified'] = False
+            user_states[user_id]['subscription_end_notified'] = False
+            forget_invoices(user_id)
+            # Обновляем данные в таблице
+            blocking.spawn('Users', update_user_subscription_in_sheet, user_id, dict(user_states[user_id]))
+            user_states[user_id]['last_payment_id'] = payment.telegram_payment_charge_id
+            
+            # Persist
+            if persistence:
+                try:
+                    user_states[user_id]['last_activity_at'] = now_msk_str()
+                    persistence.save_user_state(user_id, user_states[user_id], force=True)
+                except Exception as e:
+                    logger.warning(f"Persist save error: {e}")
+            
+            # Отправляем приветственное сообщение
+            scenario_cfg = SCENARIOS.get(user_states[user_id].get('scenario'))
+            if scenario_cfg and scenario_cfg.get('subscription_welcome'):
+                welcome_msg = scenario_cfg['subscription_welcome']
+                await update.message.reply_text(welcome_msg)
+                user_states[user_id]['conversation_history'].append({"role": "assistant", "content": welcome_msg})
+            else:
+                await update.message.reply_text("Оплата получена, доступ активирован.")
+            
+            # Уведомляем админа
             try:
-                from yookassa import Payment
-                uid = cq.from_user.id
-                amount = {"value": f"{VLASTA_PRICE_RUB:.2f}", "currency": "RUB"}
-                payment = Payment.create({
-                    "amount": amount,
-                    "confirmation": {
-                        "type": "redirect",
-                        "return_url": YOOKASSA_RETURN_URL
-                    },
-                    "capture": True,
-                    "description": "Vlasta - доступ на 7 дней",
-                    "metadata": {
-                        "telegram_user_id": str(uid),
-                        "scenario": user_states.get(uid, {}).get('scenario', 'Vlasta')
-                    },
-                    "receipt": {
-                        "items": [
-                            {
-                                "description": "Доступ к Vlasta на 7 дней",
-                                "quantity": "1.0",
-                                "amount": amount,
-                                "vat_code": VAT_CODE,
-                                "payment_mode": "full_payment",
-                                "payment_subject": "service"
-                            }
-                        ],
-                        "tax_system_code": TAX_SYSTEM_CODE,
-                        "customer": {"email": receipt_email}
-                    }
-                })
-                conf = payment.confirmation
-                if conf and conf.return_url:
-                    kb = InlineKeyboardMarkup([[InlineKeyboardButton(text="Оплатить", url=conf.return_url)]])
-                    await cq.message.reply_text("Ссылка на оплату:", reply_markup=kb)
-                else:
-                    await cq.message.reply_text("Ошибка создания ссылки на оплату")
+                await context.bot.send_message(
+                    chat_id=ADMIN_CHAT_ID,
+                    text=f"💰 Оплата от {user_id}: {payment.total_amount/100} {payment.currency}"
+                )
             except Exception as e:
-                logger.warning(f"YooKassa Payment error: {e}")
+                logger.warning(f"Admin payment notify error: {e}")
+
+    application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
+    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
+
+    # Callback for external YooKassa Smart Payment (create redirect payment)
+    async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not update.callback_query:
+            return
+        cq = update.callback_query
+        data = cq.data or ''
+        if not data.startswith('yk_redirect:'):
+            return
+        await cq.answer()
+        if not (yookassa_client and YOOKASSA_RETURN_URL):
+            await cq.message.reply_text("Ссылка на оплату временно недоступна")
+            return
+        try:
+            uid = cq.from_user.id
+            amount = {"value": f"{VLASTA_PRICE_RUB:.2f}", "currency": "RUB"}
+            receipt = {
+                "items": [
+                    {
+                        "description": "Доступ к Vlasta на 7 дней",
+                        "quantity": "1.0",
+                        "amount": amount,
+                        "vat_code": VAT_CODE,
+                        "payment_mode": "full_payment",
+                        "payment_subject": "service"
+                    }
+                ],
+                "tax_system_code": TAX_SYSTEM_CODE,
+            }
+            receipt_email = user_states.get(uid, {}).get('receipt_email')
+            if receipt_email:
+                receipt["customer"] = {"email": receipt_email}
+            payment = await yookassa_client.create_payment({
+                "amount": amount,
+                "confirmation": {
+                    "type": "redirect",
+                    "return_url": YOOKASSA_RETURN_URL
+                },
+                "capture": True,
+                "description": "Vlasta - доступ на 7 дней",
+                "metadata": {
+                    "telegram_user_id": str(uid),
+                    "scenario": user_states.get(uid, {}).get('scenario', 'Vlasta')
+                },
+                "receipt": receipt
+            })
+            pay_url = (payment.get('confirmation') or {}).get('confirmation_url')
+            if pay_url:
+                kb = InlineKeyboardMarkup([[InlineKeyboardButton(text="Оплатить", url=pay_url)]])
+                await cq.message.reply_text("Ссылка на оплату:", reply_markup=kb)
+            else:
                 await cq.message.reply_text("Ошибка создания ссылки на оплату")
+        except Exception as e:
+            logger.warning(f"YooKassa Payment error: {e}")
+            await cq.message.reply_text("Ошибка создания ссылки на оплату")
 
-        application.add_handler(CallbackQueryHandler(on_callback))
+    application.add_handler(CallbackQueryHandler(on_callback))
 
-        # SBP command
-        async def sbp_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            uid = update.effective_user.id
-            if uid not in user_states:
-                await update.message.reply_text("Сначала запустите бота командой /start")
-                return
-            await send_sbp_link(context, uid)
-        application.add_handler(CommandHandler("sbp", sbp_cmd))
+    # SBP command
+    async def sbp_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        uid = update.effective_user.id
+        if uid not in user_states:
+            await update.message.reply_text("Сначала запустите бота командой /start")
+            return
+        await send_sbp_link(context, uid)
+    application.add_handler(CommandHandler("sbp", sbp_cmd))
 
-        # Restore states at startup (last 14 days)
-        restored = 0
-        if persistence:
-            try:
-                all_states = persistence.load_all_states()
-                for uid, st in all_states.items():
-                    last_at = st.get('last_activity_at') or st.get('updated_at')
-                    ok = True
-                    if last_at:
-                        try:
-                            dt = datetime.strptime(last_at, '%Y-%m-%d %H:%M:%S')
-                            if (datetime.now(MSK_TZ) - dt).days > 14:
-                                ok = False
-                        except Exception:
-                            pass
-                    if ok:
-                        user_states[uid] = st
-                        restored += 1
-                logger.info(f"Restored {restored} user states")
-            except Exception as e:
-                logger.warning(f"States restore error: {e}")
+    # AioHTTP server setup
+    aio = web.Application()
+    port = int(os.environ.get('PORT', '8000'))
 
-        # AioHTTP server setup
-        aio = web.Application()
-        port = int(os.environ.get('PORT', '8000'))
+    # Health endpoint: запуск и доставка вебхуков без лишних вызовов Telegram (всегда 200, отвечает сразу после bind)
+    async def health(request: web.Request):
+        return web.json_response({**webhook_supervisor.snapshot(), 'startup': startup.snapshot()})
 
-        # Health endpoint
-        async def health(request: web.Request):
-            return web.Response(text="OK")
+    aio.router.add_get('/health', health)
 
-        aio.router.add_get('/health', health)
+    # Prometheus metrics (если задан METRICS_TOKEN - только с Authorization: Bearer <token>)
+    async def metrics_endpoint(request: web.Request):
+        if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+            return web.Response(status=403, text="Forbidden")
+        return web.Response(body=metrics.render().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
 
-        # Telegram webhook handler
-        async def handle_tg(request: web.Request):
-            try:
-                body = await request.json()
-                await application.update_queue.put(Update.de_json(body, application.bot))
+    aio.router.add_get('/metrics', metrics_endpoint)
+
+    # Telegram webhook handler
+    async def handle_tg(request: web.Request):
+        if ingest.closing:
+            # останавливаемся: пусть Telegram повторит доставку (уже новому экземпляру)
+            return web.Response(status=503, text="Shutting down")
+        try:
+            body = json_loads(await request.read())
+            webhook_supervisor.delivered()
+            if update_dedup.is_duplicate(body.get('update_id')):
+                # Повтор от Telegram - уже в обработке, отвечаем 200, чтобы он перестал ретраить
                 return web.Response(text="OK")
-            except Exception as e:
-                logger.warning(f"Webhook error: {e}")
-                return web.Response(status=400, text="Error")
-
-        # Short webhook handler (with secret)
-        async def handle_tg_short(request: web.Request):
-            if WEBHOOK_SECRET:
-                secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
-                if secret != WEBHOOK_SECRET:
-                    return web.Response(status=403, text="Forbidden")
-            return await handle_tg(request)
-
-        # YooKassa webhook and return endpoints
-        async def handle_yk_webhook(request: web.Request):
-            try:
-                body = await request.json()
-            except Exception:
-                return web.Response(status=400, text='bad json')
-            try:
-                obj = body.get('object') or {}
-                if obj.get('status') == 'succeeded':
-                    meta = obj.get('metadata') or {}
-                    uid_str = meta.get('telegram_user_id')
-                    if uid_str and uid_str.isdigit():
-                        uid = int(uid_str)
-                        st = user_states.get(uid)
-                        if st:
-                            until = (datetime.now(MSK_TZ) + timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
-                            st['is_subscribed'] = True
-                            st['subscription_until'] = until
-                            st['limit_notified'] = False
-                            st['subscription_end_notified'] = False
-                            # Обновляем данные в таблице
-                            update_user_subscription_in_sheet(uid, st)
-                            if persistence:
-                                try:
-                                    st['last_activity_at'] = now_msk_str()
-                                    persistence.save_user_state(uid, st, force=True)
-                                except Exception:
-                                    pass
-                            # Send welcome
-                            scen = SCENARIOS.get(st.get('scenario')) if st.get('scenario') else None
-                            msg = scen.get('subscription_welcome') if scen else "Оплата получена, доступ активирован."
+            if not ingest.offer(body):
+                return overload_reply(body)
+            return web.Response(text="OK")
+        except Exception as e:
+            logger.warning(f"Webhook error: {e}")
+            return web.Response(status=400, text="Error")
+
+    # Short webhook handler (with secret)
+    async def handle_tg_short(request: web.Request):
+        if WEBHOOK_SECRET:
+            secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
+            if secret != WEBHOOK_SECRET:
+                return web.Response(status=403, text="Forbidden")
+        return await handle_tg(request)
+
+    # YooKassa webhook and return endpoints
+    async def handle_yk_webhook(request: web.Request):
+        try:
+            body = await request.json()
+        except Exception:
+            return web.Response(status=400, text='bad json')
+        try:
+            obj = body.get('object') or {}
+            if obj.get('status') == 'succeeded':
+                payments_total.inc('yookassa')
+                meta = obj.get('metadata') or {}
+                uid_str = meta.get('telegram_user_id')
+                if uid_str and uid_str.isdigit():
+                    uid = int(uid_str)
+                    st = user_states.get(uid)
+                    if st:
+                        until = (datetime.now(MSK_TZ) + timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
+                        st['is_subscribed'] = True
+                        st['subscription_until'] = until
+                        st['limit_notified'] = False
+                        st['subscription_end_notified'] = False
+                        forget_invoices(uid)
+                        # Обновляем данные в таблице
+                        blocking.spawn('Users', update_user_subscription_in_sheet, uid, dict(st))
+                        if persistence:
                             try:
-                                await application.bot.send_message(chat_id=uid, text=msg)
+                                st['last_activity_at'] = now_msk_str()
+                                persistence.save_user_state(uid, st, force=True)
                             except Exception:
                                 pass
-                return web.Response(text='OK')
-            except Exception:
-                return web.Response(status=500, text='error')
+                        # Send welcome
+                        scen = SCENARIOS.get(st.get('scenario')) if st.get('scenario') else None
+                        msg = scen.get('subscription_welcome') if scen else "Оплата получена, доступ активирован."
+                        try:
+                            await application.bot.send_message(chat_id=uid, text=msg)
+                        except Exception:
+                            pass
+            return web.Response(text='OK')
+        except Exception:
+            return web.Response(status=500, text='error')
 
-        async def handle_yk_return(request: web.Request):
-            html = """
+    async def handle_yk_return(request: web.Request):
+        html = """
 <!DOCTYPE html>
 <html lang="ru"><head>
 <meta charset="utf-8" />
@@ -1823,7 +4158,7 @@ def main():
 <script>
 window.addEventListener('load', function(){
   if (typeof VK !== 'undefined' && VK.Retargeting) {
-    try { VK.Retargeting.Init('REPLACE_VK_PIXEL_ID'); VK.Retargeting.Hit(); } catch(e) {}
+try { VK.Retargeting.Init('REPLACE_VK_PIXEL_ID'); VK.Retargeting.Hit(); } catch(e) {}
   }
 });
 </script>
@@ -1834,101 +4169,76 @@ window.addEventListener('load', function(){
   <p>Можно закрыть эту страницу.</p>
 </body></html>
 """
-            html = html.replace('REPLACE_VK_PIXEL_ID', VK_PIXEL_ID)
-            return web.Response(text=html, content_type='text/html')
+        html = html.replace('REPLACE_VK_PIXEL_ID', VK_PIXEL_ID)
+        return web.Response(text=html, content_type='text/html')
+
+    # Define webhook paths
+    base_url = os.environ.get('WEBHOOK_BASE_URL') or os.environ.get('RENDER_EXTERNAL_URL') or ''
+    url_path = f"/webhook/{BOT_TOKEN}"
+    webhook_url = base_url.rstrip('/') + url_path if base_url else ''
+    
+    aio.router.add_post('/yookassa/webhook', handle_yk_webhook)
+    aio.router.add_get('/pay/return', handle_yk_return)
+    aio.router.add_post(url_path, handle_tg)          # token path
+    aio.router.add_post('/webhook', handle_tg_short)   # short alias path
+
+    # Сначала слушаем порт (/health и приём вебхуков), остальное - в фоне
+    runner = web.AppRunner(aio)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', port)
+    await site.start()
+    startup.record('bind', time.monotonic() - bind_started)
+    logger.info('Aiohttp server started')
+    await open_http_session()
+    if DEEPSEEK_WARMUP:
+        asyncio.create_task(warm_up_deepseek())
+
+    # Graceful stop support: сигнал только выставляет stop, остановка - в finally ниже
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
 
-        # Define webhook paths
-        base_url = os.environ.get('WEBHOOK_BASE_URL') or os.environ.get('RENDER_EXTERNAL_URL') or ''
-        url_path = f"/webhook/{BOT_TOKEN}"
-        webhook_url = base_url.rstrip('/') + url_path if base_url else ''
-        
-        aio.router.add_post('/yookassa/webhook', handle_yk_webhook)
-        aio.router.add_get('/pay/return', handle_yk_return)
-        aio.router.add_post(url_path, handle_tg)          # token path
-        aio.router.add_post('/webhook', handle_tg_short)   # short alias path
-
-        # Start app and webhook
-        await application.initialize()
-        await application.start()
-        runner = web.AppRunner(aio)
-        await runner.setup()
-        site = web.TCPSite(runner, '0.0.0.0', port)
-        await site.start()
-        logger.info('Aiohttp server started')
-        # Prefer short path with secret if configured; fallback to token path; don't crash on failure
-        short_url = base_url.rstrip('/') + '/webhook'
-        # default expected url
-        heal_expected_url = short_url if WEBHOOK_SECRET else webhook_url
-        try:
-            if WEBHOOK_SECRET:
-                await application.bot.set_webhook(short_url, secret_token=WEBHOOK_SECRET, drop_pending_updates=False, allowed_updates=Update.ALL_TYPES)
-                heal_expected_url = short_url
-                logger.info(f"Webhook set to short path with secret: {short_url}")
-            else:
-                await application.bot.set_webhook(webhook_url, drop_pending_updates=False, allowed_updates=Update.ALL_TYPES)
-                heal_expected_url = webhook_url
-                logger.info(f"Webhook set to token path: {webhook_url}")
-        except Exception as e:
-            logger.warning(f"Initial set_webhook failed: {e}")
-            try:
-                await application.bot.set_webhook(webhook_url, drop_pending_updates=False, allowed_updates=Update.ALL_TYPES)
-                heal_expected_url = webhook_url
-                logger.info(f"Webhook fallback to token path: {webhook_url}")
-            except Exception as e2:
-                logger.warning(f"Fallback set_webhook failed: {e2}")
-                heal_expected_url = webhook_url
-        # Graceful stop support
         def signal_handler(signum, frame):
             logger.info(f"Received signal {signum}, shutting down...")
-            asyncio.create_task(shutdown())
-
-        async def shutdown():
-            try:
-                heal_task.cancel()
-                await heal_task
-            except Exception:
-                pass
-            await application.stop()
-            await application.shutdown()
-            await runner.cleanup()
+            loop.call_soon_threadsafe(stop.set)
 
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
 
-        # Health check task
-        async def health_check():
-            while True:
-                try:
-                    await asyncio.sleep(30)
-                    info = await application.bot.get_webhook_info()
-                    if info.url != heal_expected_url:
-                        logger.warning(f"Webhook URL mismatch: expected {heal_expected_url}, got {info.url}")
-                        try:
-                            if WEBHOOK_SECRET:
-                                await application.bot.set_webhook(heal_expected_url, secret_token=WEBHOOK_SECRET, drop_pending_updates=False, allowed_updates=Update.ALL_TYPES)
-                            else:
-                                await application.bot.set_webhook(heal_expected_url, drop_pending_updates=False, allowed_updates=Update.ALL_TYPES)
-                            logger.info(f"Webhook restored to: {heal_expected_url}")
-                        except Exception as e:
-                            logger.warning(f"Webhook restore failed: {e}")
-                except Exception as e:
-                    logger.warning(f"Health check error: {e}")
-
-        heal_task = asyncio.create_task(health_check())
-
+    short_url = base_url.rstrip('/') + '/webhook' if base_url else ''
+    services = asyncio.create_task(start_services(application, short_url, webhook_url, stop))
+    try:
+        await stop.wait()
+    except KeyboardInterrupt:
+        logger.info("Shutdown requested")
+    finally:
+        services.cancel()
         try:
-            await asyncio.Event().wait()
-        except KeyboardInterrupt:
-            logger.info("Shutdown requested")
-        finally:
-            try:
-                heal_task.cancel()
-                await heal_task
-            except Exception:
-                pass
+            await services
+        except BaseException:
+            pass
+        await ingest.stop(application)
+        await webhook_supervisor.stop()
+        if application.running:
             await application.stop()
-            await application.shutdown()
-            await runner.cleanup()
+        await application.shutdown()
+        # фоновые записи (Users, spill) - до остановки хранилищ: SQLite закрывает соединение в stop()
+        await blocking.drain()
+        if history_writer:
+            await history_writer.stop()
+        if persistence:
+            await persistence.stop()
+        if state_snapshot:
+            await state_snapshot.stop()
+        await recent_history.stop()
+        await tracer.stop()
+        await close_http_session()
+        blocking.shutdown()
+        await runner.cleanup()
+
+
+def main():
+    logger.info("Starting MetaPersona Bot...")
 
     try:
         asyncio.run(run_server())
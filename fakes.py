@@ -0,0 +1,430 @@
+"""Локальные подмены внешних сервисов для bot.py: листы gspread, DeepSeek (OpenAI-совместимый API),
+Bot API и YooKassa.
+
+У каждой подмены есть профиль (FaultProfile): распределение задержек, доля ошибок и квота
+в духе Google API (превышение - 429). Случайность идёт от seed, поэтому 429 от Sheets и медленные
+хвосты LLM воспроизводятся от прогона к прогону.
+
+    sheets = FaultProfile(latency=Latency(median=0.08, sigma=0.4), quota=Quota(60, 60), seed=1)
+    users = FakeWorksheet('Users', USERS_COLUMNS, sheets)
+    runner = await serve([FakeBotAPI(), FakeChatCompletions(FaultProfile(latency=Latency(1.0, tail_rate=0.02, tail=8)))], port=18081)
+"""
+import abc
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+
+from aiohttp import web
+from gspread.exceptions import APIError
+
+
+# === Профиль отказов ===
+class Latency:
+    """Задержка: логнормальная вокруг median (sigma - разброс) плюс редкие хвосты tail секунд с частотой tail_rate."""
+
+    def __init__(self, median: float = 0.0, sigma: float = 0.0, tail_rate: float = 0.0, tail: float = 0.0):
+        self.median = median
+        self.sigma = sigma
+        self.tail_rate = tail_rate
+        self.tail = tail
+
+    def sample(self, rng: random.Random) -> float:
+        if self.tail_rate and rng.random() < self.tail_rate:
+            return self.tail
+        if not self.median:
+            return 0.0
+        return self.median * math.exp(rng.gauss(0, self.sigma)) if self.sigma else self.median
+
+
+class Quota:
+    """Скользящее окно: не больше limit запросов за per_secs (как квоты Google API на минуту)."""
+
+    def __init__(self, limit: int, per_secs: float = 60.0):
+        self.limit = limit
+        self.per_secs = per_secs
+        self._calls: deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def take(self) -> float | None:
+        """None - запрос в пределах квоты; иначе - через сколько секунд освободится место."""
+        now = time.monotonic()
+        with self._lock:
+            while self._calls and now - self._calls[0] >= self.per_secs:
+                self._calls.popleft()
+            if len(self._calls) >= self.limit:
+                return self.per_secs - (now - self._calls[0])
+            self._calls.append(now)
+            return None
+
+
+class FaultProfile:
+    """Поведение подмены: задержка, доля ошибок (5xx) и квота (429). Одна ГПСЧ с seed на профиль."""
+
+    def __init__(self, latency: Latency | None = None, error_rate: float = 0.0, quota: Quota | None = None,
+                 seed: int | None = 0):
+        self.latency = latency or Latency()
+        self.error_rate = error_rate
+        self.quota = quota
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def decide(self) -> tuple[float, str | None, float]:
+        """(задержка, исход: None | 'throttled' | 'error', retry_after)."""
+        with self._lock:
+            delay = self.latency.sample(self.rng)
+            failed = self.error_rate and self.rng.random() < self.error_rate
+        if self.quota:
+            wait = self.quota.take()
+            if wait is not None:
+                return delay, 'throttled', max(1.0, math.ceil(wait))
+        return delay, ('error' if failed else None), 0.0
+
+
+class CallStats:
+    def __init__(self):
+        # op -> [calls, throttled, errors]
+        self.ops: dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def count(self, op: str, outcome: str | None):
+        with self._lock:
+            st = self.ops.setdefault(op, [0, 0, 0])
+            st[0] += 1
+            st[1] += outcome == 'throttled'
+            st[2] += outcome == 'error'
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {op: {'calls': c, 'throttled': t, 'errors': e} for op, (c, t, e) in sorted(self.ops.items())}
+
+
+# === gspread ===
+class _ErrorResponse:
+    """То, что APIError читает из ответа requests: status_code, json() и text."""
+
+    def __init__(self, status: int, payload: dict):
+        self.status_code = status
+        self._payload = payload
+        self.text = json.dumps(payload)
+
+    def json(self) -> dict:
+        return self._payload
+
+
+def _api_error(status: int, message: str, reason: str) -> APIError:
+    return APIError(_ErrorResponse(status, {'error': {'code': status, 'message': message, 'status': reason}}))
+
+
+def _col(letters: str) -> int:
+    col = 0
+    for ch in letters:
+        col = col * 26 + ord(ch) - 64
+    return col
+
+
+def _a1(cell: str) -> tuple[int, int]:
+    m = re.fullmatch(r'([A-Z]+)(\d+)', cell.split('!')[-1].split(':')[0])
+    return int(m.group(2)), _col(m.group(1))
+
+
+class FakeWorksheet:
+    """Лист в памяти с методами gspread.Worksheet, которые использует bot.py.
+
+    Вызовы синхронные (как в gspread): задержка - time.sleep, отказы - gspread.exceptions.APIError
+    с кодом 429 (квота) или 503.
+    """
+
+    def __init__(self, title: str, header: list | None = None, profile: FaultProfile | None = None):
+        self.title = title
+        self.profile = profile or FaultProfile()
+        self.rows: list[list] = [list(header)] if header else []
+        self.stats = CallStats()
+        self._lock = threading.Lock()
+
+    def _call(self, op: str):
+        delay, outcome, _ = self.profile.decide()
+        if delay:
+            time.sleep(delay)
+        self.stats.count(op, outcome)
+        if outcome == 'throttled':
+            raise _api_error(429, "Quota exceeded for quota metric 'Write requests' and limit 'Write requests per minute per user'",
+                             'RESOURCE_EXHAUSTED')
+        if outcome == 'error':
+            raise _api_error(503, 'The service is currently unavailable.', 'UNAVAILABLE')
+
+    def _set(self, row: int, col: int, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append('')
+        cells[col - 1] = value
+
+    def _write(self, row: int, col: int, values):
+        for dr, vals in enumerate(values):
+            for dc, v in enumerate(vals):
+                self._set(row + dr, col + dc, v)
+
+    def append_row(self, values, **kwargs):
+        return self._append('append_row', [values])
+
+    def append_rows(self, values, **kwargs):
+        return self._append('append_rows', values)
+
+    def _append(self, op: str, values) -> dict:
+        self._call(op)
+        with self._lock:
+            first = len(self.rows) + 1
+            self.rows.extend(list(v) for v in values)
+        width = max((len(v) for v in values), default=1)
+        last_col = chr(64 + max(1, min(width, 26)))
+        return {'updates': {'updatedRange': f"'{self.title}'!A{first}:{last_col}{first + len(values) - 1}",
+                            'updatedRows': len(values)}}
+
+    def row_values(self, row: int, **kwargs):
+        self._call('row_values')
+        with self._lock:
+            return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def col_values(self, col: int, **kwargs):
+        self._call('col_values')
+        with self._lock:
+            return [r[col - 1] if len(r) >= col else '' for r in self.rows]
+
+    def get_all_values(self, **kwargs):
+        self._call('get_all_values')
+        with self._lock:
+            return [list(r) for r in self.rows]
+
+    def get_all_records(self, expected_headers=None, **kwargs):
+        self._call('get_all_records')
+        with self._lock:
+            if not self.rows:
+                return []
+            header = self.rows[0]
+            return [{h: (r[i] if i < len(r) else '') for i, h in enumerate(header)} for r in self.rows[1:]]
+
+    def batch_get(self, ranges, **kwargs):
+        self._call('batch_get')
+        with self._lock:
+            return [self._range_values(r) for r in ranges]
+
+    def _range_values(self, range_name: str) -> list[list]:
+        """Значения диапазона ('B12', 'A:A', 'A2:D5') без хвостовых пустых ячеек и строк, как в API."""
+        m = re.fullmatch(r'([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?', range_name.split('!')[-1])
+        first_col, first_row = _col(m.group(1)), int(m.group(2) or 1)
+        if m.group(3) is None:
+            last_col, last_row = first_col, (first_row if m.group(2) else len(self.rows))
+        else:
+            last_col, last_row = _col(m.group(3)), int(m.group(4) or len(self.rows))
+        values = []
+        for row in self.rows[first_row - 1:last_row]:
+            cells = list(row[first_col - 1:last_col])
+            while cells and cells[-1] == '':
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def update(self, range_name, values=None, **kwargs):
+        self._call('update')
+        with self._lock:
+            self._write(*_a1(range_name), values or [])
+
+    def update_cell(self, row: int, col: int, value):
+        self._call('update_cell')
+        with self._lock:
+            self._set(row, col, value)
+
+    def batch_update(self, data, **kwargs):
+        self._call('batch_update')
+        with self._lock:
+            for item in data:
+                self._write(*_a1(item['range']), item['values'])
+
+    def clear(self):
+        self._call('clear')
+        with self._lock:
+            self.rows = []
+
+    def delete_rows(self, start_index: int, end_index: int | None = None):
+        self._call('delete_rows')
+        with self._lock:
+            del self.rows[start_index - 1:(end_index or start_index)]
+
+
+# === HTTP-подмены ===
+class _FakeService(abc.ABC):
+    prefix = ''
+
+    def __init__(self, profile: FaultProfile | None = None):
+        self.profile = profile or FaultProfile()
+        self.stats = CallStats()
+
+    async def _gate(self, op: str) -> tuple[str | None, float]:
+        delay, outcome, retry_after = self.profile.decide()
+        if delay:
+            await asyncio.sleep(delay)
+        self.stats.count(op, outcome)
+        return outcome, retry_after
+
+    @abc.abstractmethod
+    def routes(self, app: web.Application):
+        """Регистрирует маршруты подмены в приложении aiohttp."""
+
+
+class FakeBotAPI(_FakeService):
+    """Bot API: /tg/bot<token>/<method>. Запоминает вебхук и число сообщений по чатам.
+
+    throttled -> 429 с parameters.retry_after (PTB поднимет RetryAfter), error -> 502.
+    """
+
+    prefix = '/tg'
+
+    def __init__(self, profile: FaultProfile | None = None):
+        super().__init__(profile)
+        self.webhook_url = ''
+        self.pending_update_count = 0
+        self.messages_by_chat: dict[int, int] = {}
+        self._message_id = 0
+
+    def routes(self, app: web.Application):
+        app.router.add_post(self.prefix + '/bot{token}/{method}', self.handle)
+        app.router.add_get(self.prefix + '/bot{token}/{method}', self.handle)
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        outcome, retry_after = await self._gate(method)
+        if outcome == 'throttled':
+            return web.json_response({'ok': False, 'error_code': 429,
+                                      'description': f"Too Many Requests: retry after {int(retry_after)}",
+                                      'parameters': {'retry_after': int(retry_after)}}, status=429)
+        if outcome == 'error':
+            return web.json_response({'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}, status=502)
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        return web.json_response({'ok': True, 'result': self.result(method, params)})
+
+    def result(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url', '')
+            return True
+        if method == 'deleteWebhook':
+            self.webhook_url = ''
+            return True
+        if method == 'getWebhookInfo':
+            return {'url': self.webhook_url, 'has_custom_certificate': False,
+                    'pending_update_count': self.pending_update_count}
+        if method.startswith(('send', 'edit', 'copy', 'forward')):
+            self._message_id += 1
+            chat_id = int(params.get('chat_id') or 0)
+            self.messages_by_chat[chat_id] = self.messages_by_chat.get(chat_id, 0) + 1
+            return {'message_id': self._message_id, 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        return True
+
+
+class FakeChatCompletions(_FakeService):
+    """OpenAI-совместимый POST /v1/chat/completions: обычный ответ и SSE (stream: true).
+
+    Задержка профиля - время до первого байта; в потоке токены идут каждые token_interval секунд.
+    throttled -> 429 с Retry-After, error -> 503.
+    """
+
+    prefix = '/v1'
+
+    def __init__(self, profile: FaultProfile | None = None, reply_tokens: int = 40, token_interval: float = 0.01,
+                 token: str = 'Слово'):
+        super().__init__(profile)
+        self.reply_tokens = reply_tokens
+        self.token_interval = token_interval
+        self.token = token
+
+    def routes(self, app: web.Application):
+        app.router.add_post(self.prefix + '/chat/completions', self.handle)
+
+    async def handle(self, request: web.Request):
+        body = await request.json()
+        outcome, retry_after = await self._gate('stream' if body.get('stream') else 'complete')
+        if outcome == 'throttled':
+            return web.json_response({'error': {'message': 'Rate limit reached', 'type': 'rate_limit_error'}},
+                                     status=429, headers={'Retry-After': str(int(retry_after))})
+        if outcome == 'error':
+            return web.json_response({'error': {'message': 'Server is busy', 'type': 'server_error'}}, status=503)
+        pieces = [self.token + ' '] * self.reply_tokens
+        if not body.get('stream'):
+            if self.token_interval:
+                await asyncio.sleep(self.token_interval * len(pieces))
+            return web.json_response({
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'model': body.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(pieces).strip()},
+                             'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': len(pieces), 'total_tokens': len(pieces)},
+            })
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        for piece in pieces:
+            if self.token_interval:
+                await asyncio.sleep(self.token_interval)
+            chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk',
+                     'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+
+class FakeYooKassa(_FakeService):
+    """YooKassa v3: POST /yk/invoices и /yk/payments."""
+
+    prefix = '/yk'
+
+    def routes(self, app: web.Application):
+        app.router.add_post(self.prefix + '/invoices', self.invoice)
+        app.router.add_post(self.prefix + '/payments', self.payment)
+
+    async def _fail(self, op: str):
+        outcome, retry_after = await self._gate(op)
+        if outcome == 'throttled':
+            return web.json_response({'type': 'error', 'code': 'too_many_requests', 'description': 'Too many requests'},
+                                     status=429, headers={'Retry-After': str(int(retry_after))})
+        if outcome == 'error':
+            return web.json_response({'type': 'error', 'code': 'internal_server_error', 'description': 'Internal error'},
+                                     status=500)
+        return None
+
+    async def invoice(self, request: web.Request):
+        failed = await self._fail('invoices')
+        if failed:
+            return failed
+        inv_id = f"inv-{self.profile.rng.getrandbits(48):x}"
+        return web.json_response({'id': inv_id, 'status': 'pending',
+                                  'delivery_method': {'type': 'self', 'url': f"https://yoomoney.example/{inv_id}"}})
+
+    async def payment(self, request: web.Request):
+        failed = await self._fail('payments')
+        if failed:
+            return failed
+        pay_id = f"pay-{self.profile.rng.getrandbits(48):x}"
+        return web.json_response({'id': pay_id, 'status': 'pending',
+                                  'confirmation': {'type': 'redirect', 'confirmation_url': f"https://yoomoney.example/{pay_id}"}})
+
+
+async def serve(services, port: int, host: str = '127.0.0.1') -> web.AppRunner:
+    """Поднимает все подмены на одном aiohttp-сервере; адреса - f"http://{host}:{port}{service.prefix}"."""
+    app = web.Application()
+    for service in services:
+        service.routes(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
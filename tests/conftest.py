@@ -0,0 +1,22 @@
+"""Окружение для импорта bot.py в тестах: без Google Sheets, внешние API - подмены из fakes.py на STAND_IN_PORT."""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STAND_IN_PORT = 18391
+STAND_IN = f"http://127.0.0.1:{STAND_IN_PORT}"
+
+os.environ.pop('GOOGLE_CREDENTIALS', None)
+os.environ.pop('WEBHOOK_SECRET', None)
+os.environ.update({
+    'BOT_TOKEN': '123456:test',
+    'DEEPSEEK_API_KEY': 'test',
+    'DEEPSEEK_BASE_URL': f"{STAND_IN}/v1",
+    'TELEGRAM_BASE_URL': f"{STAND_IN}/tg",
+    'LOCAL_DATA_DIR': tempfile.mkdtemp(prefix='metapersona-test-'),
+    'STORAGE_BACKEND': 'sheets',
+    'DEEPSEEK_WARMUP': '0',
+})
@@ -0,0 +1,28 @@
+import asyncio
+import time
+
+import bot
+from conftest import STAND_IN_PORT
+from fakes import FakeChatCompletions, FaultProfile, Latency, serve
+
+
+async def _request_with_slow_provider(latency: float):
+    llm = FakeChatCompletions(FaultProfile(Latency(latency)))
+    runner = await serve([llm], STAND_IN_PORT)
+    try:
+        started = time.monotonic()
+        reply = await bot.deepseek_request('вопрос', [], {})
+        return reply, time.monotonic() - started
+    finally:
+        await bot.close_http_session()
+        await runner.cleanup()
+
+
+def test_deadline_bounds_a_slow_attempt(monkeypatch):
+    monkeypatch.setattr(bot, 'DEEPSEEK_DEADLINE', 1.0)
+    monkeypatch.setattr(bot, 'deepseek_breaker', bot.CircuitBreaker(5, 30))
+    reply, elapsed = asyncio.run(_request_with_slow_provider(latency=3.0))
+    assert reply is None
+    assert elapsed < 1.5
+    # истёкший дедлайн - одна неудача размыкателя на запрос
+    assert bot.deepseek_breaker.failures == 1
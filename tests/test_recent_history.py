@@ -0,0 +1,29 @@
+import asyncio
+import os
+
+import bot
+
+
+def test_index_evicts_idle_users_and_compacts_off_the_loop(tmp_path):
+    async def scenario():
+        index = bot.RecentHistoryIndex(str(tmp_path / 'recent.jsonl'), limit=2, max_users=3, flush_secs=0.01)
+        index.start()
+        for uid in range(5):
+            for i in range(4):
+                index.add(uid, 'user', f"{uid}-{i}")
+        # пишет фоновая задача, не add()
+        assert not os.path.exists(index.path)
+        await asyncio.sleep(0.1)
+        assert list(index.turns) == [2, 3, 4]
+        assert index.kept == 6
+        await index.compact()
+        await index.stop()
+        return index
+
+    index = asyncio.run(scenario())
+    reloaded = bot.RecentHistoryIndex(index.path, limit=2, max_users=3)
+    reloaded.load()
+    assert reloaded.recent(4, 10) == [{'role': 'user', 'content': '4-2'}, {'role': 'user', 'content': '4-3'}]
+    assert reloaded.recent(0, 10) == []
+    with open(index.path, encoding='utf-8') as fh:
+        assert sum(1 for _ in fh) == 6
@@ -0,0 +1,91 @@
+import asyncio
+import json
+
+import bot
+from fakes import FakeWorksheet
+
+STATES_HEADER = ['user_id', 'state_json', 'updated_at', 'last_activity_at']
+
+
+class _Application:
+    """Минимум Application, который нужен стадии приёма."""
+
+    def __init__(self):
+        self.update_queue = asyncio.Queue()
+        self.bot = None
+        self.running = True
+
+
+def _message(update_id: int, user_id: int, text: str) -> dict:
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+    }}
+
+
+def test_newer_sheets_row_wins_over_snapshot_user_seen_during_restore(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'user_states', {})
+    snapshot = bot.StateSnapshot(str(tmp_path / 'states_snapshot.json'), 300)
+    monkeypatch.setattr(bot, 'state_snapshot', snapshot)
+    snapshot_at = '2026-01-10 12:00:00'
+    with open(snapshot.path, 'w', encoding='utf-8') as fh:
+        json.dump({'saved_at': snapshot_at, 'states': {'42': {
+            'scenario': 'Vlasta', 'is_subscribed': False, 'free_used': 5, 'last_activity_at': snapshot_at,
+        }}}, fh)
+    # после снимка пользователь оплатил подписку (другой экземпляр бота записал строку в Sheets)
+    paid_at = '2026-01-10 12:05:00'
+    sheet = FakeWorksheet('States', STATES_HEADER)
+    sheet.rows.append(['42', json.dumps({'scenario': 'Vlasta', 'is_subscribed': True, 'free_used': 5,
+                                         'last_activity_at': paid_at}), paid_at, paid_at])
+    monkeypatch.setattr(bot, 'persistence', bot.SheetsPersistence(sheet))
+    monkeypatch.setattr(bot, 'sheets_persistence', bot.persistence)
+    monkeypatch.setattr(bot, 'state_is_recent', lambda state, days=14: True)
+
+    async def scenario():
+        stage = bot.IngestStage(100, 10)
+        app = _Application()
+        await bot.restore_snapshot()
+        assert bot.user_states[42]['is_subscribed'] is False
+        # STARTUP_RESTORE_TIMEOUT истёк: насос работает, но пользователь из снимка ждёт сверки с Sheets
+        stage.start(app)
+        stage.offer(_message(1, 42, 'привет'))
+        await asyncio.sleep(0.05)
+        assert app.update_queue.empty()
+        assert await bot.restore_states()
+        stage.restored()
+        await asyncio.sleep(0.05)
+        assert app.update_queue.qsize() == 1
+        await stage.stop(app)
+
+    asyncio.run(scenario())
+    assert bot.user_states[42]['is_subscribed'] is True
+
+
+def test_changed_rows_are_read_in_blocks(monkeypatch):
+    old, new = '2026-01-10 11:00:00', '2026-01-10 12:05:00'
+    sheet = FakeWorksheet('States', STATES_HEADER)
+    for uid in range(1, 101):
+        stamp = new if uid in (2, 3, 9, 80) else old
+        sheet.rows.append([str(uid), json.dumps({'free_used': uid}), stamp, stamp])
+    ranges = []
+    batch_get = sheet.batch_get
+
+    def recording_batch_get(requested, **kwargs):
+        ranges.append(list(requested))
+        return batch_get(requested, **kwargs)
+
+    monkeypatch.setattr(sheet, 'batch_get', recording_batch_get)
+    persistence = bot.SheetsPersistence(sheet)
+    expected = {uid: {'free_used': uid} for uid in (2, 3, 9, 80)}
+
+    assert persistence.load_changed_since('2026-01-10 12:00:00') == expected
+    # строки 3, 4, 10 - один блок (пропуск меньше STATE_SNAPSHOT_BLOCK_GAP), строка 81 - второй
+    assert ranges == [['A:A', 'C:C'], ['B3:B10', 'B81:B81']]
+    assert persistence.user_row_cache[80] == 81
+
+    ranges.clear()
+    monkeypatch.setattr(bot, 'STATE_SNAPSHOT_MAX_BLOCKS', 1)
+    assert persistence.load_changed_since('2026-01-10 12:00:00') == expected
+    assert ranges == [['A:A', 'C:C'], ['B:B']]
+    assert sheet.stats.summary()['batch_get']['calls'] == 4
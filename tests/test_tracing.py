@@ -0,0 +1,36 @@
+import asyncio
+import json
+
+import bot
+
+
+def test_spans_after_trace_end_are_dropped_and_jsonl_is_buffered(tmp_path, monkeypatch):
+    tracer = bot.Tracer(1.0, 60, 10, str(tmp_path / 'traces.jsonl'), flush_secs=0.01)
+    monkeypatch.setattr(bot, 'tracer', tracer)
+
+    async def scenario():
+        async def background():
+            with bot.trace_span('early'):
+                pass
+            await asyncio.sleep(0.05)
+            with bot.trace_span('late'):
+                pass
+
+        trace, token = tracer.begin(kind='message')
+        with bot.trace_span('inline'):
+            task = asyncio.create_task(background())
+            await asyncio.sleep(0.01)
+        tracer.end(trace, token)
+        # пишет фоновая задача, не end()
+        assert not (tmp_path / 'traces.jsonl').exists()
+        await task
+        await tracer.stop()
+        return trace
+
+    trace = asyncio.run(scenario())
+    assert [sp[0] for sp in trace.spans] == ['early', 'inline']
+    assert tracer.late_spans == 1
+    with open(tmp_path / 'traces.jsonl', encoding='utf-8') as fh:
+        rows = [json.loads(line) for line in fh]
+    assert [r['id'] for r in rows] == [trace.id]
+    assert [sp['name'] for sp in rows[0]['spans']] == ['early', 'inline']
@@ -0,0 +1,47 @@
+import asyncio
+
+import bot
+
+
+class _Bot:
+    def __init__(self):
+        self.set_webhook_calls = []
+
+    async def set_webhook(self, url, **kwargs):
+        self.set_webhook_calls.append(url)
+        return True
+
+
+class _Application:
+    """Минимум Application для start_services: Telegram «поднимается» мгновенно."""
+
+    def __init__(self):
+        self.bot = _Bot()
+        self.update_queue = asyncio.Queue()
+        self.running = False
+
+    async def initialize(self):
+        pass
+
+    async def start(self):
+        self.running = True
+
+
+def test_no_public_url_skips_webhook_registration(tmp_path, monkeypatch):
+    supervisor = bot.WebhookSupervisor(0.01, 0.01, 100)
+    monkeypatch.setattr(bot, 'webhook_supervisor', supervisor)
+    monkeypatch.setattr(bot, 'ingest', bot.IngestStage(100, 10))
+    monkeypatch.setattr(bot, 'recent_history', bot.RecentHistoryIndex(str(tmp_path / 'recent.jsonl')))
+    monkeypatch.setattr(bot, 'state_snapshot', None)
+    app = _Application()
+
+    async def scenario():
+        await bot.start_services(app, '', '', asyncio.Event())
+        await asyncio.sleep(0.05)
+        await bot.ingest.stop(app)
+        await bot.recent_history.stop()
+
+    asyncio.run(scenario())
+    assert app.bot.set_webhook_calls == []
+    assert supervisor.snapshot()['status'] == 'disabled'
+    assert supervisor._task is None